@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""Benchmarks of hashing, dependency resolution, index loading, downloading and index generation on synthetic
+repositories.
+
+Run from the repository root with the package importable, e.g.:
+
+    PYTHONPATH=src python benchmarks/bench.py --scales 100,1000 --save-baseline benchmarks/baseline.json
+    PYTHONPATH=src python benchmarks/bench.py --scales 100,1000 --baseline benchmarks/baseline.json
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+import lpu.apt.common
+from lpu.apt.indices import IndexCache
+from lpu.apt.packages import get_package_with_dependencies, download_packages_with_dependencies, \
+    resolve_dependencies
+from lpu.apt.repository import generate_packages_file, generate_release_file
+from lpu.common import file_digest, hash_files, HashEngine
+from lpu.download import Downloader
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from synthetic import generate_pool, build_fake_cache, write_packages_index, LocalHTTPServer, best_time  # noqa: E402
+
+
+def bench_file_digest(ctx):
+    def run():
+        for f in ctx["files"]:
+            with open(f, "rb") as fp:
+                # noinspection PyTypeChecker
+                file_digest(fp, hashlib.sha256)
+
+    return run, None, len(ctx["files"]), ctx["pool_bytes"]
+
+
+def bench_hash_files(ctx):
+    engine = HashEngine()
+
+    def run():
+        for _ in hash_files(ctx["files"], hashlib.sha256, engine=engine):
+            pass
+
+    return run, None, len(ctx["files"]), ctx["pool_bytes"]
+
+
+def bench_resolve(ctx):
+    resolved = get_package_with_dependencies(ctx["top_package"])
+
+    def run():
+        get_package_with_dependencies(ctx["top_package"])
+
+    return run, None, len(resolved), 0
+
+
+def bench_index_cache(ctx):
+    packages_file = os.path.join(ctx["work_dir"], "Packages")
+    write_packages_index(packages_file, ctx["specs"])
+
+    def run():
+        cache = IndexCache.from_files([packages_file], "amd64", "http://127.0.0.1")
+        resolve_dependencies([ctx["top_package"]], cache=cache)
+        cache.close()
+
+    return run, None, len(ctx["specs"]), os.path.getsize(packages_file)
+
+
+def bench_download(ctx):
+    dest_dir = os.path.join(ctx["work_dir"], "download")
+    resolved = get_package_with_dependencies(ctx["top_package"])
+    size = sum(lpu.apt.common.get_cache()[p].versions[0].size for p in resolved)
+
+    def setup():
+        shutil.rmtree(dest_dir, ignore_errors=True)
+        os.makedirs(dest_dir)
+
+    def run():
+        download_packages_with_dependencies([ctx["top_package"]], dest_dir, Downloader(jobs=8, jobs_per_host=8))
+
+    return run, setup, len(resolved), size
+
+
+def check_download_resume(ctx):
+    """Resume a download from a .partial file against servers that honour, reject and ignore Range requests."""
+    dest_dir = os.path.join(ctx["work_dir"], "resume-check")
+    filename = os.path.basename(ctx["files"][0])
+    with open(ctx["files"][0], "rb") as fp:
+        content = fp.read()
+    cases = [
+        # The rest of the file comes in a 206 response, and is appended to the partial file
+        (ctx["range_server"], content[:len(content) // 2], [206]),
+        # A partial file longer than the remote one gets a 416 response, and the retry starts over
+        (ctx["range_server"], content + b"\0", [416, 200]),
+        # A server ignoring the Range header sends the whole file, which replaces the partial one
+        (ctx["server"], content[:len(content) // 2], [200]),
+    ]
+    for server, partial, statuses in cases:
+        shutil.rmtree(dest_dir, ignore_errors=True)
+        os.makedirs(dest_dir)
+        filepath = os.path.join(dest_dir, filename)
+        with open(f"{filepath}.partial", "wb") as fp:
+            fp.write(partial)
+        del server.statuses[:]
+        Downloader(retries=1, backoff=0).download(f"{server.base_uri}/{filename}", filepath,
+                                                  hashlib.sha256(content).hexdigest())
+        with open(filepath, "rb") as fp:
+            resumed = fp.read()
+        if server.statuses != statuses or resumed != content or os.path.exists(f"{filepath}.partial"):
+            raise Exception(f"Resuming from {len(partial)} of {len(content)} bytes: expected {statuses} responses "
+                            f"and the whole file, got {server.statuses} and {len(resumed)} bytes")
+
+
+def bench_download_resume(ctx):
+    check_download_resume(ctx)
+    dest_dir = os.path.join(ctx["work_dir"], "resume")
+    downloads = []
+    for f in ctx["files"]:
+        with open(f, "rb") as fp:
+            sha256 = hashlib.sha256(fp.read()).hexdigest()
+        downloads.append((f"{ctx['range_server'].base_uri}/{os.path.basename(f)}",
+                          os.path.join(dest_dir, os.path.basename(f)), sha256))
+
+    def setup():
+        shutil.rmtree(dest_dir, ignore_errors=True)
+        os.makedirs(dest_dir)
+        # Half of each package was downloaded by an interrupted run
+        for f in ctx["files"]:
+            with open(f, "rb") as src, open(os.path.join(dest_dir, f"{os.path.basename(f)}.partial"), "wb") as dst:
+                dst.write(src.read(os.path.getsize(f) // 2))
+
+    def run():
+        Downloader(jobs=8, jobs_per_host=8).download_all(downloads)
+
+    return run, setup, len(ctx["files"]), sum(os.path.getsize(f) - os.path.getsize(f) // 2 for f in ctx["files"])
+
+
+def bench_packages_file(ctx):
+    architecture_dir = os.path.join(ctx["work_dir"], "dists", "bench", "main", "binary-amd64")
+    os.makedirs(architecture_dir, exist_ok=True)
+
+    def run():
+        generate_packages_file(ctx["work_dir"], architecture_dir, ctx["pool_dir"])
+
+    return run, None, len(ctx["files"]), ctx["pool_bytes"]
+
+
+def bench_release_file(ctx):
+    dist_dir = os.path.join(ctx["work_dir"], "dists", "release")
+    component_dir = os.path.join(dist_dir, "main")
+    i18n_dir = os.path.join(component_dir, "i18n")
+    os.makedirs(i18n_dir, exist_ok=True)
+    # One index file per package, to get Release files with as many entries as large repositories have
+    size = 0
+    for i in range(ctx["scale"]):
+        with open(os.path.join(i18n_dir, f"Translation-l{i:06d}"), "wb") as fp:
+            content = f"Package: bench-pkg{i:06d}\nDescription-md5: {i:032x}\n\n".encode() * 8
+            fp.write(content)
+            size += len(content)
+
+    def run():
+        generate_release_file(dist_dir, "main", "amd64", component_dir, codename="bench")
+
+    return run, None, ctx["scale"], size
+
+
+benchmarks = {
+    "file_digest": bench_file_digest,
+    "hash_files": bench_hash_files,
+    "get_package_with_dependencies": bench_resolve,
+    "index_cache": bench_index_cache,
+    "download_packages_with_dependencies": bench_download,
+    "download_resume": bench_download_resume,
+    "generate_packages_file": bench_packages_file,
+    "generate_release_file": bench_release_file,
+}
+
+
+def run_scale(scale, payload_size, repeat, selected):
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="lpu-bench-") as work_dir:
+        pool_dir = os.path.join(work_dir, "dists", "bench", "pool", "main", "amd64")
+        specs = generate_pool(pool_dir, scale, payload_size)
+        files = [f for _, _, _, f in specs]
+        with LocalHTTPServer(pool_dir) as server, LocalHTTPServer(pool_dir, ranges=True) as range_server:
+            saved_cache = lpu.apt.common._cache
+            lpu.apt.common._cache = build_fake_cache(specs, server.base_uri)
+            try:
+                ctx = {
+                    "scale": scale,
+                    "work_dir": work_dir,
+                    "pool_dir": pool_dir,
+                    "files": files,
+                    "specs": specs,
+                    "pool_bytes": sum(os.path.getsize(f) for f in files),
+                    "top_package": specs[-1][0],
+                    "server": server,
+                    "range_server": range_server,
+                }
+                for name in selected:
+                    run, setup, count, size = benchmarks[name](ctx)
+                    seconds = best_time(run, repeat, setup)
+                    results[name] = {
+                        "seconds": seconds,
+                        "files": count,
+                        "bytes": size,
+                        "files_per_second": count / seconds,
+                        "mb_per_second": size / seconds / 2 ** 20,
+                    }
+            finally:
+                lpu.apt.common._cache = saved_cache
+    return results
+
+
+def compare(results, baseline, max_regression):
+    regressions = []
+    for scale, scale_results in results.items():
+        for name, result in scale_results.items():
+            base = baseline.get(scale, {}).get(name)
+            if base is None:
+                continue
+            ratio = result["files_per_second"] / base["files_per_second"]
+            result["baseline_ratio"] = ratio
+            if ratio < 1 - max_regression:
+                regressions.append(f"{name} at scale {scale}: {ratio:.2f}x of baseline")
+    return regressions
+
+
+def print_report(results):
+    print(f"{'benchmark':<38} {'scale':>7} {'seconds':>9} {'files/s':>11} {'MB/s':>9} {'vs base':>8}")
+    for scale, scale_results in results.items():
+        for name, r in scale_results.items():
+            ratio = f"{r['baseline_ratio']:.2f}x" if "baseline_ratio" in r else "-"
+            print(f"{name:<38} {scale:>7} {r['seconds']:>9.4f} {r['files_per_second']:>11.1f} "
+                  f"{r['mb_per_second']:>9.1f} {ratio:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark lpu on synthetic repositories")
+    parser.add_argument("--scales", default="100,1000",
+                        help="Comma separated numbers of packages to generate (default is 100,1000)")
+    parser.add_argument("--payload-size", type=int, default=16 * 1024,
+                        help="Size of the data in each synthetic package, in bytes (default is 16384)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of runs of each benchmark, the best one is reported (default is 3)")
+    parser.add_argument("--only", action="append", choices=sorted(benchmarks),
+                        help="Run only this benchmark, may be repeated")
+    parser.add_argument("--baseline",
+                        help="Compare against the results stored in this file")
+    parser.add_argument("--max-regression", type=float, default=0.2,
+                        help="Fail if throughput drops by more than this fraction of the baseline (default is 0.2)")
+    parser.add_argument("--save-baseline",
+                        help="Store the results in this file, to compare later runs against")
+    parser.add_argument("--json",
+                        help="Write the results to this file as JSON")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, force=True)
+
+    results = {
+        scale: run_scale(int(scale), args.payload_size, args.repeat, args.only or list(benchmarks))
+        for scale in args.scales.split(",")
+    }
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, "r") as fp:
+            regressions = compare(results, json.load(fp), args.max_regression)
+    print_report(results)
+    for path in [args.json, args.save_baseline]:
+        if path:
+            with open(path, "w") as fp:
+                json.dump(results, fp, indent=2, sort_keys=True)
+    if regressions:
+        print("Regressions:\n" + "\n".join(f"  {r}" for r in regressions), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+"""Synthetic package pools, a stand-in for apt.cache.Cache and a local HTTP server for the benchmarks."""
+import functools
+import gzip
+import hashlib
+import http.server
+import io
+import os
+import random
+import re
+import shutil
+import tarfile
+import threading
+import time
+
+
+def _tar_gz(files):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb", mtime=0) as gz:
+        with tarfile.open(fileobj=gz, mode="w") as tar:
+            for name, data in files.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mtime = 0
+                tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def _ar(members):
+    out = [b"!<arch>\n"]
+    for name, data in members:
+        out.append(f"{name:<16}{0:<12}{0:<6}{0:<6}{100644:<8}{len(data):<10}`\n".encode())
+        out.append(data + (b"\n" if len(data) % 2 else b""))
+    return b"".join(out)
+
+
+def build_deb(filename, package, version, architecture, depends, payload):
+    control = "".join([
+        f"Package: {package}\n",
+        f"Version: {version}\n",
+        f"Architecture: {architecture}\n",
+        "Maintainer: Benchmark <benchmark@example.com>\n",
+        f"Installed-Size: {len(payload) // 1024 + 1}\n",
+        *([f"Depends: {depends}\n"] if depends else []),
+        "Section: misc\n",
+        "Priority: optional\n",
+        f"Description: Synthetic package {package}\n",
+        " Generated for benchmarking.\n",
+    ])
+    with open(filename, "wb") as fp:
+        fp.write(_ar([
+            ("debian-binary", b"2.0\n"),
+            ("control.tar.gz", _tar_gz({"./control": control.encode()})),
+            ("data.tar.gz", _tar_gz({f"./usr/share/{package}/data": payload})),
+        ]))
+
+
+def generate_pool(pool_dir, count, payload_size=16 * 1024, max_depends=3, alternatives_ratio=0.1,
+                  architecture="amd64", seed=0):
+    """Write count synthetic packages to pool_dir. Each package depends on up to max_depends packages with a lower
+    index, some of them as alternatives. The last package, bench-all, depends on all the others, so resolving it
+    pulls in the whole pool.
+
+    Returns the package specs, as (name, version, depends, filename), depends being a list of lists of names.
+    """
+    rnd = random.Random(seed)
+    os.makedirs(pool_dir, exist_ok=True)
+    specs = []
+    for i in range(count):
+        name = f"bench-pkg{i:06d}"
+        depends = []
+        for _ in range(rnd.randint(0, min(i, max_depends))):
+            group = [f"bench-pkg{rnd.randrange(i):06d}"]
+            if rnd.random() < alternatives_ratio:
+                group.append(f"bench-pkg{rnd.randrange(i):06d}")
+            depends.append(group)
+        filename = os.path.join(pool_dir, f"{name}_1.0_{architecture}.deb")
+        # Compressed payloads would be too small to measure throughput, so the payload is incompressible
+        build_deb(filename, name, "1.0", architecture, ", ".join(" | ".join(g) for g in depends),
+                  rnd.getrandbits(payload_size * 8).to_bytes(payload_size, "little"))
+        specs.append((name, "1.0", depends, filename))
+    depends = [[name] for name, _, _, _ in specs]
+    filename = os.path.join(pool_dir, f"bench-all_1.0_{architecture}.deb")
+    build_deb(filename, "bench-all", "1.0", architecture, ", ".join(g[0] for g in depends), b"")
+    specs.append(("bench-all", "1.0", depends, filename))
+    return specs
+
+
+def write_packages_index(filename, specs, architecture="amd64"):
+    """Write a Packages index for specs, with the fields and descriptions of a real archive's stanzas but without
+    the packages behind them."""
+    with open(filename, "w") as fp:
+        for name, version, depends, _ in specs:
+            fp.write("".join([
+                f"Package: {name}\n",
+                f"Architecture: {architecture}\n",
+                f"Version: {version}\n",
+                "Priority: optional\n",
+                "Section: misc\n",
+                "Maintainer: Benchmark <benchmark@example.com>\n",
+                "Installed-Size: 64\n",
+                *([f"Depends: {', '.join(' | '.join(g) for g in depends)}\n"] if depends else []),
+                f"Filename: pool/main/{name}_{version}_{architecture}.deb\n",
+                "Size: 4096\n",
+                f"MD5sum: {hashlib.md5(name.encode()).hexdigest()}\n",
+                f"SHA1: {hashlib.sha1(name.encode()).hexdigest()}\n",
+                f"SHA256: {hashlib.sha256(name.encode()).hexdigest()}\n",
+                f"Description: Synthetic package {name}\n",
+                " Generated for benchmarking, with a long description like most packages have. It spans\n",
+                " a few lines, which the index has to skip over without parsing them.\n",
+                "\n",
+            ]))
+
+
+class FakeBaseDependency(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeDependency(list):
+    """Like apt.package.Dependency, a list of alternative BaseDependency objects."""
+
+    @property
+    def or_dependencies(self):
+        return self
+
+
+@functools.total_ordering
+class FakeVersion(object):
+    def __init__(self, version, architecture, dependencies, filename, sha256, size, uri):
+        self.version = version
+        self.architecture = architecture
+        self.dependencies = dependencies
+        self.filename = filename
+        self.sha256 = sha256
+        self.size = size
+        self.uri = uri
+
+    def __eq__(self, other):
+        return self.version == other.version
+
+    def __lt__(self, other):
+        return self.version < other.version
+
+
+class FakePackage(object):
+    def __init__(self, name, versions):
+        self.name = name
+        self.versions = versions
+
+
+class FakeCache(object):
+    """The subset of apt.cache.Cache that lpu.apt.packages uses."""
+
+    def __init__(self, packages):
+        self._packages = {p.name: p for p in packages}
+
+    def __getitem__(self, name):
+        return self._packages[name]
+
+    def __contains__(self, name):
+        return name in self._packages
+
+    def __len__(self):
+        return len(self._packages)
+
+
+def build_fake_cache(specs, base_uri, architecture="amd64"):
+    packages = []
+    for name, version, depends, filename in specs:
+        with open(filename, "rb") as fp:
+            sha256 = hashlib.sha256(fp.read()).hexdigest()
+        packages.append(FakePackage(name, [FakeVersion(
+            version, architecture,
+            [FakeDependency(FakeBaseDependency(n) for n in group) for group in depends],
+            f"pool/{os.path.basename(filename)}", sha256, os.path.getsize(filename),
+            f"{base_uri}/{os.path.basename(filename)}")]))
+    return FakeCache(packages)
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    """Ignores Range headers, like SimpleHTTPRequestHandler, and records the status of each response."""
+
+    def log_request(self, code="-", size="-"):
+        self.server.statuses.append(int(code))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _RangeHandler(_QuietHandler):
+    """Serves the rest of a file from the offset of a "bytes=<offset>-" Range header, like package mirrors do for
+    resumed downloads."""
+
+    def do_GET(self):
+        match = re.match(r"^bytes=(\d+)-$", self.headers.get("Range", ""))
+        path = self.translate_path(self.path)
+        if match is None or not os.path.isfile(path):
+            return super().do_GET()
+        start = int(match.group(1))
+        size = os.path.getsize(path)
+        if start >= size:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(206)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Range", f"bytes {start}-{size - 1}/{size}")
+        self.send_header("Content-Length", str(size - start))
+        self.end_headers()
+        with open(path, "rb") as fp:
+            fp.seek(start)
+            shutil.copyfileobj(fp, self.wfile)
+
+
+class _HTTPServer(http.server.ThreadingHTTPServer):
+    # With the default backlog of 5, concurrent downloads get connections dropped and retried a second later
+    request_queue_size = 64
+
+
+class LocalHTTPServer(object):
+    """Serves a directory over HTTP on a free local port, in a background thread. With ranges=True, Range requests
+    are honoured. The statuses of the responses sent are kept in statuses."""
+
+    def __init__(self, directory, ranges=False):
+        self.server = _HTTPServer(
+            ("127.0.0.1", 0), functools.partial(_RangeHandler if ranges else _QuietHandler, directory=directory))
+        self.server.statuses = []
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_uri(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    @property
+    def statuses(self):
+        return self.server.statuses
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def best_time(fn, repeat=3, setup=None):
+    """The best wall time of repeat runs of fn, running setup (untimed) before each."""
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
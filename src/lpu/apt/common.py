@@ -1,14 +1,104 @@
+import contextlib
+import hashlib
 import logging
+import os
 import subprocess
+import threading
+import time
 
-import apt.cache
+from lpu.metrics import check_output
 
-cache = apt.cache.Cache()
+apt_lists_dir = "/var/lib/apt/lists"
 
+_cache = None
+_cache_lock = threading.Lock()
 
-def update_apt_cache():
-    subprocess.check_output(["apt", "update"], stderr=subprocess.STDOUT)
-    cache.open()
+
+def get_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            # noinspection PyUnresolvedReferences
+            import apt.cache  # TODO: Figure out whether we have python3-apt, if not, call apt install using subprocess
+            _cache = apt.cache.Cache()
+        return _cache
+
+
+def get_apt_lists_age(lists_dir=apt_lists_dir):
+    # apt sets the mtime of the list files themselves from the server, but every update creates and removes files in
+    # these directories.
+    mtimes = [os.stat(d).st_mtime for d in [lists_dir, os.path.join(lists_dir, "partial")] if os.path.isdir(d)]
+    return time.time() - max(mtimes) if mtimes else None
+
+
+def get_apt_lists_state(lists_dir=apt_lists_dir):
+    """A digest of the names, sizes and mtimes of the list files, which changes whenever an update changes them."""
+    digestobj = hashlib.sha256()
+    if os.path.isdir(lists_dir):
+        for entry in sorted(os.scandir(lists_dir), key=lambda e: e.name):
+            if entry.is_file() and entry.name != "lock":
+                st = entry.stat()
+                digestobj.update(f"{entry.name}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+    return digestobj.hexdigest()
+
+
+def update_apt_cache(max_age=None):
+    if max_age:
+        age = get_apt_lists_age()
+        if age is not None and age < max_age:
+            logging.info(f"APT lists were updated {age:.0f}s ago, skipping apt update.")
+            return
+    check_output(["apt", "update"], stderr=subprocess.STDOUT)
+    with _cache_lock:
+        if _cache is not None:
+            _cache.open()
+
+
+target_config_keys = ["Dir", "Dir::State::status", "Dir::bin::dpkg", "Dir::Etc::Trusted", "Dir::Etc::TrustedParts",
+                      "APT::Architecture"]
+
+
+@contextlib.contextmanager
+def open_target_cache(rootdir, sources, architecture, max_age=None):
+    """Open an apt cache for another suite and/or architecture than the host's, in a private root directory.
+
+    apt_pkg keeps its configuration in a process-wide object, so target caches have to be used one at a time. The
+    host configuration is restored when the context exits.
+    """
+    # noinspection PyUnresolvedReferences
+    import apt.cache
+    # noinspection PyUnresolvedReferences
+    import apt_pkg
+
+    with _cache_lock:
+        saved_config = {k: apt_pkg.config.get(k) for k in target_config_keys if apt_pkg.config.exists(k)}
+        saved_architectures = apt_pkg.config.value_list("APT::Architectures")
+        trusted = apt_pkg.config.find_file("Dir::Etc::Trusted")
+        trusted_parts = apt_pkg.config.find_dir("Dir::Etc::TrustedParts")
+        try:
+            os.makedirs(os.path.join(rootdir, "etc", "apt"), exist_ok=True)
+            with open(os.path.join(rootdir, "etc", "apt", "sources.list"), "w") as fp:
+                fp.write("".join(f"{line}\n" for line in sources))
+            apt_pkg.config.set("Dir::Etc::Trusted", trusted)
+            apt_pkg.config.set("Dir::Etc::TrustedParts", trusted_parts)
+            apt_pkg.config.set("APT::Architecture", architecture)
+            apt_pkg.config.clear("APT::Architectures")
+            apt_pkg.config.set("APT::Architectures::", architecture)
+            cache = apt.cache.Cache(rootdir=rootdir)
+            age = get_apt_lists_age(os.path.join(rootdir, "var", "lib", "apt", "lists"))
+            if not max_age or age is None or age >= max_age:
+                cache.update()
+                cache.open()
+            yield cache
+        finally:
+            for k in target_config_keys:
+                apt_pkg.config.clear(k)
+            for k, v in saved_config.items():
+                apt_pkg.config.set(k, v)
+            apt_pkg.config.clear("APT::Architectures")
+            for a in saved_architectures:
+                apt_pkg.config.set("APT::Architectures::", a)
+            apt_pkg.init_system()
 
 
 package_dependencies = {
@@ -20,6 +110,7 @@ package_dependencies = {
 
 
 def install_dependencies(check_only):
+    cache = get_cache()
     missing_dependencies = set()
     needs_commit = False
     for pd_name in package_dependencies:
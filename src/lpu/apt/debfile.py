@@ -0,0 +1,128 @@
+import io
+import tarfile
+
+from lpu.compression import decompressors, decompress
+
+ar_magic = b"!<arch>\n"
+ar_header_size = 60
+
+# The order dpkg-scanpackages writes fields of a binary package index stanza in. Fields not listed here are
+# written afterwards, in the order they appear in the control file.
+packages_field_order = [
+    "Package", "Package-Type", "Source", "Version", "Kernel-Version", "Built-Using", "Static-Built-Using",
+    "Built-For-Profiles", "Auto-Built-Package", "Architecture", "Subarchitecture", "Installer-Menu-Item",
+    "Essential", "Origin", "Bugs", "Maintainer", "Installed-Size", "Protected", "Build-Essential", "Provides",
+    "Pre-Depends", "Depends", "Recommends", "Suggests", "Conflicts", "Breaks", "Replaces", "Enhances",
+    "Filename", "Size", "MD5sum", "SHA1", "SHA256", "Section", "Priority", "Multi-Arch", "Homepage",
+    "Description", "Tag", "Task",
+]
+
+
+def iter_ar_members(fp):
+    if fp.read(len(ar_magic)) != ar_magic:
+        raise ValueError("Not an ar archive")
+    offset = len(ar_magic)
+    while True:
+        fp.seek(offset)
+        header = fp.read(ar_header_size)
+        if not header:
+            return
+        if len(header) < ar_header_size or header[58:60] != b"`\n":
+            raise ValueError(f"Malformed ar member header at offset {offset}")
+        name = header[:16].decode().strip().rstrip("/")
+        size = int(header[48:58].decode().strip())
+        yield name, size
+        offset += ar_header_size + size + size % 2
+
+
+def decompress_member(name, data):
+    extension = name.rsplit(".", maxsplit=1)[-1]
+    if extension in decompressors:
+        return decompress(data, extension)
+    elif extension == "tar":
+        return data
+    raise ValueError(f"Unsupported compression for ar member {name}")
+
+
+def read_control(filename):
+    with open(filename, "rb") as fp:
+        for name, size in iter_ar_members(fp):
+            if name.startswith("control.tar"):
+                control_tar = decompress_member(name, fp.read(size))
+                break
+        else:
+            raise ValueError(f"No control archive found in {filename}")
+    with tarfile.open(fileobj=io.BytesIO(control_tar)) as tar:
+        for member in tar:
+            if member.isfile() and member.name in {"control", "./control"}:
+                return tar.extractfile(member).read().decode()
+    raise ValueError(f"No control file found in {filename}")
+
+
+class _MemberReader(object):
+    """A file object over the data of the current ar member, for streaming it into tarfile."""
+
+    def __init__(self, fp, size):
+        self.fp = fp
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fp.read(size)
+        self.remaining -= len(data)
+        return data
+
+
+def read_data_files(filename):
+    """The paths of the files and symlinks in the data archive of a package, as listed in a Contents index."""
+    with open(filename, "rb") as fp:
+        for name, size in iter_ar_members(fp):
+            if name.startswith("data.tar"):
+                if name.rsplit(".", maxsplit=1)[-1] in {"gz", "xz", "bz2", "tar"}:
+                    tar = tarfile.open(fileobj=_MemberReader(fp, size), mode="r|*")
+                else:
+                    tar = tarfile.open(fileobj=io.BytesIO(decompress_member(name, fp.read(size))), mode="r|")
+                with tar:
+                    return [
+                        member.name[2:] if member.name.startswith("./") else member.name.lstrip("/")
+                        for member in tar
+                        if not member.isdir()
+                    ]
+    raise ValueError(f"No data archive found in {filename}")
+
+
+def read_contents(filename):
+    """The qualified name (section/package) of a package, and the files it contains."""
+    fields = parse_control(read_control(filename))
+    section = fields.get("Section")
+    return f"{section}/{fields['Package']}" if section else fields["Package"], read_data_files(filename)
+
+
+def parse_control(text):
+    fields = {}
+    field = None
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        if line[0] in " \t":
+            if field is None:
+                raise ValueError(f"Continuation line without a field: {line!r}")
+            fields[field] += "\n" + line
+        else:
+            field, value = line.split(":", maxsplit=1)
+            fields[field] = value.strip()
+    return fields
+
+
+def format_control(fields):
+    lines = []
+    for k, v in fields.items():
+        lines.append(f"{k}:{v}" if v.startswith("\n") else f"{k}: {v}")
+    return "\n".join(lines) + "\n"
+
+
+def order_packages_fields(fields):
+    ordered = {k: fields[k] for k in packages_field_order if k in fields}
+    ordered.update((k, v) for k, v in fields.items() if k not in ordered)
+    return ordered
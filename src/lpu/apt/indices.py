@@ -0,0 +1,319 @@
+import functools
+import glob
+import logging
+import os
+import re
+import tempfile
+from urllib.parse import urlsplit
+from urllib.request import url2pathname
+
+import requests
+
+from lpu.apt.debfile import parse_control
+from lpu.apt.package_index import StringTable, open_package_index
+from lpu.apt.sources import apt_base_dir, apt_gpg_key_base_dir
+from lpu.apt.version import version_compare
+from lpu.download import Downloader
+from lpu.gpg import gpgv_verify
+
+# In order of preference, "" being the uncompressed index
+index_extensions = ["xz", "gz", "zst", ""]
+
+dependency_regex = re.compile(
+    r"^(?P<name>[^\s(\[<]+)\s*"
+    r"(?:\(\s*(?P<relation><<|<=|>=|>>|=|<|>)\s*(?P<version>[^\s)]+)\s*\))?")
+
+# Fields of a Packages stanza that versions are built from, besides the columns of PackageIndex
+version_fields = ["Filename", "SHA256", "Size", "Depends", "Pre-Depends"]
+
+
+class IndexBaseDependency(object):
+    """Like apt.package.BaseDependency, a single package name with an optional version relation."""
+    __slots__ = ("name", "relation", "version")
+
+    def __init__(self, name, relation="", version=""):
+        self.name = name
+        self.relation = relation
+        self.version = version
+
+    def __repr__(self):
+        return f"{self.name} ({self.relation} {self.version})" if self.relation else self.name
+
+
+class IndexDependency(list):
+    """Like apt.package.Dependency, a list of alternative IndexBaseDependency objects."""
+
+    @property
+    def or_dependencies(self):
+        return self
+
+    def __repr__(self):
+        return " | ".join(map(repr, self))
+
+
+def parse_dependency_field(text):
+    result = []
+    for group in text.split(","):
+        alternatives = IndexDependency()
+        for alternative in group.split("|"):
+            match = dependency_regex.match(alternative.strip())
+            if not match:
+                continue
+            name = match.group("name")
+            # Architecture qualifiers other than :any only matter for multi-arch installs, which a single
+            # architecture index cannot express. :any is left to the resolver.
+            if ":" in name and not name.endswith(":any"):
+                name = name.split(":", maxsplit=1)[0]
+            alternatives.append(IndexBaseDependency(name, match.group("relation") or "", match.group("version") or ""))
+        if alternatives:
+            result.append(alternatives)
+    return result
+
+
+@functools.total_ordering
+class IndexVersion(object):
+    """Like apt.package.Version, a version of a package as listed in a Packages index, ordered like dpkg orders
+    versions. Dependencies are parsed on first use."""
+    __slots__ = ("package", "version", "architecture", "filename", "sha256", "size", "uri", "_depends",
+                 "_dependencies")
+
+    def __init__(self, package, version, architecture, filename, sha256, size, uri, depends=""):
+        self.package = package
+        self.version = version
+        self.architecture = architecture
+        self.filename = filename
+        self.sha256 = sha256
+        self.size = size
+        self.uri = uri
+        self._depends = depends
+        self._dependencies = None
+
+    @property
+    def dependencies(self):
+        if self._dependencies is None:
+            self._dependencies = parse_dependency_field(self._depends) if self._depends else []
+        return self._dependencies
+
+    def __eq__(self, other):
+        return version_compare(self.version, other.version) == 0
+
+    def __lt__(self, other):
+        return version_compare(self.version, other.version) < 0
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"<IndexVersion {self.package} {self.version} {self.architecture}>"
+
+
+class IndexPackage(object):
+    def __init__(self, name):
+        self.name = name
+        self.versions = []
+
+
+class IndexCache(object):
+    """The subset of apt.cache.Cache that lpu.apt.packages uses, read directly from Packages indices.
+
+    The indices are kept as memory mapped PackageIndex objects sharing one string table, and packages are only
+    built from their stanzas when they are looked up. Like in apt's cache, names only provided by other packages are
+    not packages themselves, get_providing_packages lists their providers.
+    """
+
+    def __init__(self, architecture=None):
+        self.architecture = architecture
+        self.strings = StringTable()
+        self._indices = []
+        self._name_ids = set()
+        self._packages = {}
+        self._providers = {}
+
+    def add_packages_file(self, filename, base_uri="", decompressed_filename=None):
+        """Add a Packages index, whose Filename fields are relative to base_uri."""
+        index = open_package_index(filename, self.architecture, self.strings, decompressed_filename)
+        self._indices.append((index, base_uri.rstrip("/")))
+        self._name_ids.update(index.name_ids())
+        for name, provides in index.provides:
+            for provided in parse_dependency_field(provides):
+                self._providers.setdefault(provided[0].name, set()).add(name)
+
+    def _is_real(self, name):
+        return self.strings.id(name) in self._name_ids
+
+    def _get_package(self, name):
+        package = self._packages.get(name)
+        if package is not None:
+            return package
+        package = IndexPackage(name)
+        for index, base_uri in self._indices:
+            for i in index.find(name):
+                version = self.strings[index.versions[i]]
+                # The same version is often listed by several suites of a repository, e.g. release and updates
+                if any(v.version == version for v in package.versions):
+                    continue
+                fields = index.fields(i, version_fields)
+                filename = fields["Filename"] or ""
+                package.versions.append(IndexVersion(
+                    name, version, self.strings[index.architectures[i]], filename, fields["SHA256"],
+                    int(fields["Size"] or 0), f"{base_uri}/{filename}" if base_uri and filename else None,
+                    ", ".join(filter(None, [fields["Pre-Depends"], fields["Depends"]]))))
+        self._packages[name] = package
+        return package
+
+    def get_providing_packages(self, name):
+        """Like apt.cache.Cache.get_providing_packages, the packages providing a name no package is called."""
+        if self._is_real(name):
+            return []
+        return [self._get_package(provider) for provider in sorted(self._providers.get(name, ()))]
+
+    def __getitem__(self, name):
+        if not self._is_real(name):
+            raise KeyError(f"The index has no package named {name!r}")
+        return self._get_package(name)
+
+    def __contains__(self, name):
+        return self._is_real(name)
+
+    def keys(self):
+        return [self.strings[name_id] for name_id in self._name_ids]
+
+    def __len__(self):
+        return len(self._name_ids)
+
+    def close(self):
+        for index, _ in self._indices:
+            index.close()
+
+    @classmethod
+    def from_files(cls, filenames, architecture=None, base_uri=""):
+        cache = cls(architecture)
+        for filename in filenames:
+            cache.add_packages_file(filename, base_uri)
+        return cache
+
+    @classmethod
+    def from_sources(cls, sources, architecture, cache_dir, downloader=None):
+        """Fetch, verify and read the Packages indices of sources, as returned by get_repository_sources."""
+        cache = cls(architecture)
+        downloader = downloader or Downloader()
+        indices = []
+        for source in sources:
+            indices.extend(get_source_indices(source, architecture, cache_dir, downloader.session))
+        os.makedirs(os.path.join(cache_dir, "indices"), exist_ok=True)
+        downloader.download_all({
+            filename: (url, filename, sha256) for url, filename, sha256, _ in indices if not os.path.isfile(filename)
+        }.values())
+        for _, filename, sha256, base_uri in indices:
+            cache.add_packages_file(filename, base_uri, os.path.join(cache_dir, "indices", f"{sha256}.Packages"))
+        return cache
+
+
+def get_default_keyrings():
+    return [
+        f for f in [os.path.join(apt_base_dir, "trusted.gpg")] + sorted(glob.glob(f"{apt_gpg_key_base_dir}/*.gpg"))
+        if os.path.isfile(f)
+    ]
+
+
+def read_uri(uri, session=None):
+    """The content of an http(s) or file URI, or None if it does not exist."""
+    parts = urlsplit(uri)
+    if parts.scheme == "file":
+        try:
+            with open(url2pathname(parts.path), "rb") as fp:
+                return fp.read()
+        except FileNotFoundError:
+            return None
+    r = (session or requests).get(uri, timeout=60)
+    if r.status_code == 404:
+        return None
+    r.raise_for_status()
+    return r.content
+
+
+def strip_clearsign(content):
+    """The signed text of a clearsigned message, without verifying the signature."""
+    text = content.decode("utf-8")
+    if not text.startswith("-----BEGIN PGP SIGNED MESSAGE-----"):
+        return text
+    body = text.partition("\n\n")[2].split("\n-----BEGIN PGP SIGNATURE-----", maxsplit=1)[0]
+    return "\n".join(line[2:] if line.startswith("- ") else line for line in body.split("\n")) + "\n"
+
+
+def fetch_release(dist_uri, keyrings=None, session=None):
+    """Fetch the InRelease, or Release and Release.gpg, file of a dist, verified against keyrings unless it is None."""
+    content = read_uri(f"{dist_uri}/InRelease", session)
+    if content is not None:
+        if keyrings is None:
+            return strip_clearsign(content)
+        return gpgv_verify(content, keyrings).decode("utf-8")
+    content = read_uri(f"{dist_uri}/Release", session)
+    if content is None:
+        raise Exception(f"No InRelease or Release file found in {dist_uri}")
+    if keyrings is None:
+        return content.decode("utf-8")
+    signature = read_uri(f"{dist_uri}/Release.gpg", session)
+    if signature is None:
+        raise Exception(f"{dist_uri}/Release is not signed")
+    with tempfile.NamedTemporaryFile(suffix=".gpg") as fp:
+        fp.write(signature)
+        fp.flush()
+        return gpgv_verify(content, keyrings, fp.name).decode("utf-8")
+
+
+def parse_release_files(release, field="SHA256"):
+    """The (hexdigest, size) of each file listed in a Release file, by path."""
+    result = {}
+    for line in parse_control(release).get(field, "").splitlines():
+        parts = line.split()
+        if len(parts) == 3:
+            result[parts[2]] = parts[0], int(parts[1])
+    return result
+
+
+def _get_source_keyrings(source):
+    options = source.get("options") or {}
+    if options.get("trusted") == "yes":
+        return None
+    signed_by = options.get("signed-by")
+    if signed_by:
+        # signed-by may also list fingerprints, which restrict the keys instead of naming keyrings
+        keyrings = [k for k in (signed_by if isinstance(signed_by, list) else [signed_by]) if os.path.isfile(k)]
+        if keyrings:
+            return keyrings
+    keyrings = get_default_keyrings()
+    if not keyrings:
+        raise Exception(f"No keyring to verify {source['uri']} {source['suite']} with, set a key_url, a signed-by "
+                        f"option or trusted: yes in its options")
+    return keyrings
+
+
+def get_source_indices(source, architecture, cache_dir, session=None):
+    """The Packages indices of a source for an architecture, as (url, filename, sha256, base_uri) tuples.
+
+    Indices are kept in the cache directory by digest, so unchanged ones are not downloaded again.
+    """
+    uri = source["uri"].rstrip("/")
+    suite = source["suite"]
+    if suite.endswith("/"):
+        # Flat repository, with the indices and packages in a single directory
+        dist_uri = f"{uri}/{suite.rstrip('/')}".rstrip("/")
+        base_uri = dist_uri
+        index_paths = ["Packages"]
+    else:
+        dist_uri = f"{uri}/dists/{suite}"
+        base_uri = uri
+        index_paths = [f"{component}/binary-{architecture}/Packages" for component in source["components"]]
+    release_files = parse_release_files(fetch_release(dist_uri, _get_source_keyrings(source), session))
+    result = []
+    for index_path in index_paths:
+        for extension in index_extensions:
+            path = f"{index_path}.{extension}" if extension else index_path
+            if path in release_files:
+                sha256, _ = release_files[path]
+                filename = os.path.join(cache_dir, "indices", f"{sha256}.{extension}" if extension else sha256)
+                result.append((f"{dist_uri}/{path}", filename, sha256, base_uri))
+                break
+        else:
+            logging.warning(f"{dist_uri} has no {index_path} index, skipping")
+    return result
@@ -0,0 +1,62 @@
+import hashlib
+import json
+import logging
+import os
+
+from lpu.common import walk_files
+
+
+def get_files_state(paths, base_dir=None):
+    """Describe the files under paths (files or directories) by size, mtime and inode, without reading them."""
+    state = {}
+    for path in paths:
+        for f in walk_files(path) if os.path.isdir(path) else [path]:
+            if os.path.isfile(f):
+                st = os.stat(f)
+                state[os.path.relpath(f, base_dir) if base_dir else f] = [st.st_size, st.st_mtime_ns, st.st_ino]
+    return state
+
+
+def fingerprint(inputs):
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class BuildManifest(object):
+    """Inputs of each stage of the last successful build, used to skip stages whose inputs did not change."""
+
+    def __init__(self, filename, force=False):
+        self.filename = filename
+        self.force = force
+        self.stages = {}
+        if os.path.isfile(filename):
+            try:
+                with open(filename, "r") as fp:
+                    self.stages = json.load(fp)["stages"]
+            except (ValueError, KeyError) as e:
+                logging.warning(f"Ignoring unreadable build manifest {filename}: {e}")
+
+    def is_current(self, stage, inputs):
+        current = not self.force and stage in self.stages and self.stages[stage]["inputs"] == fingerprint(inputs)
+        if current:
+            logging.info(f"Inputs of {stage} are unchanged since the last build, skipping.")
+        return current
+
+    def get_outputs(self, stage):
+        return self.stages[stage].get("outputs")
+
+    def update(self, stage, inputs, outputs=None):
+        self.stages[stage] = {"inputs": fingerprint(inputs), "outputs": outputs}
+        self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+        with open(f"{self.filename}.tmp", "w") as fp:
+            json.dump({"stages": self.stages}, fp, indent=1, sort_keys=True)
+        os.replace(f"{self.filename}.tmp", self.filename)
+
+
+def get_build_manifest(config):
+    output_dir = os.path.abspath(config["output_dir"])
+    filename = config["manifest_file"] or os.path.join(
+        config["cache_dir"], "manifests", f"{hashlib.sha256(output_dir.encode()).hexdigest()[:16]}.json")
+    return BuildManifest(filename, config["force_rebuild"])
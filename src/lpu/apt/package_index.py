@@ -0,0 +1,166 @@
+import mmap
+import os
+import tempfile
+from array import array
+
+from lpu.apt.debfile import parse_control
+from lpu.compression import decompress_file, decompressors
+
+
+class StringTable(object):
+    """Interns strings as small integer ids, so that values repeated across stanzas, like architectures, are stored
+    once and columns can hold ids instead of references."""
+
+    def __init__(self):
+        self.strings = []
+        self._ids = {}
+
+    def intern(self, s):
+        i = self._ids.get(s)
+        if i is None:
+            i = self._ids[s] = len(self.strings)
+            self.strings.append(s)
+        return i
+
+    def id(self, s):
+        return self._ids.get(s)
+
+    def __getitem__(self, i):
+        return self.strings[i]
+
+    def __len__(self):
+        return len(self.strings)
+
+
+def _find_field(data, key, start, end):
+    """The value of a single line field (key including the colon) of the stanza at data[start:end], or None."""
+    if data[start:start + len(key)] == key:
+        i = start + len(key)
+    else:
+        i = data.find(b"\n" + key, start, end)
+        if i < 0:
+            return None
+        i += len(key) + 1
+    j = data.find(b"\n", i, end)
+    return data[i:j if j >= 0 else end].strip().decode("utf-8")
+
+
+class PackageIndex(object):
+    """A read-only index of a Packages file, which stays on disk, memory mapped.
+
+    Only the stanza offsets and lengths are kept in memory, in arrays, along with the interned package name, version
+    and architecture of each stanza. A stanza is parsed when it is asked for. Stanzas with the same package name are
+    chained through the next column, starting from a hash index of names, so finding all versions of a package does
+    not scan the file.
+    """
+
+    def __init__(self, filename, architecture=None, strings=None):
+        self.filename = filename
+        self.strings = strings if strings is not None else StringTable()
+        self.offsets = array("Q")
+        self.lengths = array("L")
+        self.names = array("L")
+        self.versions = array("L")
+        self.architectures = array("L")
+        self.next = array("l")
+        self.provides = []
+        self._heads = {}
+        self._tails = {}
+        with open(filename, "rb") as fp:
+            size = os.fstat(fp.fileno()).st_size
+            self._data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        self._scan(architecture)
+
+    def _scan(self, architecture):
+        data = self._data
+        size = len(data)
+        allowed_architectures = None if architecture is None else {architecture, "all"}
+        intern = self.strings.intern
+        start = 0
+        while start < size:
+            while start < size and data[start:start + 1] == b"\n":
+                start += 1
+            end = data.find(b"\n\n", start)
+            if end < 0:
+                end = size
+            if end > start:
+                name = _find_field(data, b"Package:", start, end)
+                version = _find_field(data, b"Version:", start, end)
+                stanza_architecture = _find_field(data, b"Architecture:", start, end) or ""
+                if name is not None and version is not None and (
+                        allowed_architectures is None or stanza_architecture in allowed_architectures):
+                    self._add(start, end, intern(name), intern(version), intern(stanza_architecture))
+                    provides = _find_field(data, b"Provides:", start, end)
+                    if provides:
+                        self.provides.append((name, provides))
+            start = end + 2
+        # Only needed to chain stanzas while scanning
+        self._tails = None
+
+    def _add(self, start, end, name_id, version_id, architecture_id):
+        i = len(self.offsets)
+        self.offsets.append(start)
+        self.lengths.append(end - start)
+        self.names.append(name_id)
+        self.versions.append(version_id)
+        self.architectures.append(architecture_id)
+        self.next.append(-1)
+        if name_id in self._tails:
+            self.next[self._tails[name_id]] = i
+        else:
+            self._heads[name_id] = i
+        self._tails[name_id] = i
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __contains__(self, name):
+        name_id = self.strings.id(name)
+        return name_id is not None and name_id in self._heads
+
+    def name_ids(self):
+        return self._heads.keys()
+
+    def find(self, name):
+        """The indices of the stanzas of a package, in file order."""
+        name_id = self.strings.id(name)
+        i = self._heads.get(name_id, -1) if name_id is not None else -1
+        while i >= 0:
+            yield i
+            i = self.next[i]
+
+    def raw_stanza(self, i):
+        return self._data[self.offsets[i]:self.offsets[i] + self.lengths[i]].decode("utf-8")
+
+    def stanza(self, i):
+        return parse_control(self.raw_stanza(i))
+
+    def fields(self, i, keys):
+        """Single line fields of a stanza, without parsing all of it."""
+        start = self.offsets[i]
+        end = start + self.lengths[i]
+        return {k: _find_field(self._data, f"{k}:".encode(), start, end) for k in keys}
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+
+
+def open_package_index(filename, architecture=None, strings=None, decompressed_filename=None):
+    """A PackageIndex of a Packages file, decompressing compressed ones to decompressed_filename first, or to an
+    anonymous temporary file when it is None."""
+    extension = os.path.splitext(filename)[1][1:]
+    if extension not in decompressors:
+        return PackageIndex(filename, architecture, strings)
+    if decompressed_filename is None:
+        with tempfile.NamedTemporaryFile(prefix="lpu-Packages-") as dst:
+            with open(filename, "rb") as src:
+                decompress_file(src, dst, extension)
+            dst.flush()
+            # The mapping stays valid after the file is removed
+            return PackageIndex(dst.name, architecture, strings)
+    if not os.path.isfile(decompressed_filename):
+        with open(filename, "rb") as src, open(f"{decompressed_filename}.tmp", "wb") as dst:
+            decompress_file(src, dst, extension)
+        os.replace(f"{decompressed_filename}.tmp", decompressed_filename)
+    return PackageIndex(decompressed_filename, architecture, strings)
@@ -2,57 +2,281 @@ import hashlib
 import logging
 import os
 
-from lpu.apt.common import cache
-from lpu.common import file_digest
+import yaml
 
+from lpu.apt.common import get_cache, open_target_cache, get_apt_lists_age, get_apt_lists_state
+from lpu.apt.indices import IndexCache
+from lpu.apt.sources import get_target_sources, SourcesIndex, fetch_repository_keyrings, get_repository_sources
+from lpu.apt.version import version_satisfies
+from lpu.common import hash_file, get_codename, get_dpkg_architecture
+from lpu.download import Downloader
+from lpu.metrics import metrics
+from lpu.store import link_file
 
-def get_latest_version(package):
-    return sorted(cache[package].versions)[-1]
 
+def get_latest_version(package, latest_versions=None, cache=None):
+    cache = cache or get_cache()
+    if latest_versions is None:
+        return max(cache[package].versions)
+    if package not in latest_versions:
+        latest_versions[package] = max(cache[package].versions)
+    return latest_versions[package]
 
-def get_package_with_dependencies(package):
-    result = set()
 
-    def _normalize_name(p):
-        return p[:-len(":any")] if p.endswith(":any") else p
+def _normalize_name(p):
+    return p[:-len(":any")] if p.endswith(":any") else p
+
 
-    def _recurse_dependencies(p):
-        p = _normalize_name(p)
+def _is_satisfied(dependency, latest_versions, cache):
+    """Whether the version resolved for a dependency alternative satisfies its version relation."""
+    name = _normalize_name(dependency.name)
+    if name not in cache:
+        return False
+    # apt's relation uses < and > for strict relations, relation_deb has them as dpkg writes them
+    relation = getattr(dependency, "relation_deb", getattr(dependency, "relation", ""))
+    if not relation:
+        return True
+    return version_satisfies(get_latest_version(name, latest_versions, cache).version, relation, dependency.version)
+
+
+def resolve_dependencies(packages, latest_versions=None, cache=None):
+    cache = cache or get_cache()
+    latest_versions = {} if latest_versions is None else latest_versions
+    result = set()
+    pending = [_normalize_name(p) for p in packages]
+    # (dependency, names) of dependencies only satisfied by packages providing one of the names
+    virtual = []
+    while pending or virtual:
+        if pending:
+            p = pending.pop()
+        else:
+            # Provided names are resolved once every real dependency is selected, so a provider is only added when
+            # no selected package provides them already
+            dependency, names = virtual.pop(0)
+            providers = sorted({provider.name for name in names for provider in cache.get_providing_packages(name)})
+            if not providers:
+                raise Exception(f"Dependency not found in cache: {dependency}")
+            if any(provider in result for provider in providers):
+                continue
+            p = providers[0]
         if p in result:
-            return
+            continue
+        if p not in cache:
+            virtual.append((p, [p]))
+            continue
         result.add(p)
-        for dependency in get_latest_version(p).dependencies:
+        for dependency in get_latest_version(p, latest_versions, cache).dependencies:
             if hasattr(dependency, 'or_dependencies') and dependency.or_dependencies:
-                ods = [od for od in dependency.or_dependencies if _normalize_name(od.name) in cache]
-                if not ods:
+                ods = [od for od in dependency.or_dependencies if _is_satisfied(od, latest_versions, cache)]
+                if ods:
+                    pending.extend(_normalize_name(od.name) for od in ods)
+                    continue
+                names = [_normalize_name(od.name) for od in dependency.or_dependencies]
+                virtual_names = [name for name in names if name not in cache and cache.get_providing_packages(name)]
+                if virtual_names:
+                    virtual.append((dependency, virtual_names))
+                elif any(name in cache for name in names):
+                    raise Exception(f"No version in cache satisfies dependency: {dependency}")
+                else:
                     raise Exception(f"Dependency not found in cache: {dependency}")
-                for od in ods:
-                    _recurse_dependencies(od.name)
             elif len(dependency) == 1:
-                _recurse_dependencies(dependency[0].name)
+                pending.append(_normalize_name(dependency[0].name))
             else:
                 raise Exception(f"Can't process dependency: {dependency}")
+    return result
+
+
+def get_package_with_dependencies(package):
+    return resolve_dependencies([package])
+
+
+def get_lock_entry(package, version):
+    return {
+        "package": package,
+        "version": version.version,
+        "architecture": version.architecture,
+        "filename": os.path.basename(version.filename),
+        "sha256": version.sha256,
+        "size": version.size,
+        "uri": version.uri,
+    }
+
+
+def lock_packages(packages, latest_versions=None, cache=None):
+    latest_versions = {} if latest_versions is None else latest_versions
+    return [
+        get_lock_entry(package, get_latest_version(package, latest_versions, cache))
+        for package in sorted(resolve_dependencies(packages, latest_versions, cache))
+    ]
+
+
+def get_host_target():
+    return get_codename(), get_dpkg_architecture()["DEB_HOST_ARCH"]
+
+
+def get_target_rootdir(cache_dir, suite, architecture):
+    return os.path.join(cache_dir, "apt", f"{suite}-{architecture}")
+
+
+def get_targets_lists_state(targets, cache_dir, apt_update_max_age=None):
+    """The state of the APT lists each target resolves against, or None if resolving would update them first."""
+    host_target = get_host_target()
+    result = {}
+    for suite, architecture in targets:
+        if (suite, architecture) == host_target:
+            result[f"{suite}/{architecture}"] = get_apt_lists_state()
+        else:
+            lists_dir = os.path.join(get_target_rootdir(cache_dir, suite, architecture), "var", "lib", "apt", "lists")
+            age = get_apt_lists_age(lists_dir)
+            if not apt_update_max_age or age is None or age >= apt_update_max_age:
+                return None
+            result[f"{suite}/{architecture}"] = get_apt_lists_state(lists_dir)
+    return result
+
+
+resolvers = ["apt", "index"]
 
-    _recurse_dependencies(package)
+
+def open_index_cache(suite, architecture, cache_dir, repositories, keyrings=None, downloader=None):
+    """An IndexCache of the configured repositories for a target, for resolving without apt."""
+    sources = get_repository_sources(repositories, suite, architecture, keyrings)
+    if not sources:
+        raise Exception("The index resolver needs at least one repository to read Packages indices from")
+    return IndexCache.from_sources(sources, architecture, cache_dir, downloader)
+
+
+def lock_targets(packages, targets, cache_dir, apt_update_max_age=None, resolver="apt", repositories=None,
+                 downloader=None):
+    result = {}
+    if resolver == "index":
+        keyrings = fetch_repository_keyrings(repositories, cache_dir)
+        for suite, architecture in targets:
+            logging.info(f"Resolving packages for {suite}/{architecture} from repository indices ...")
+            cache = open_index_cache(suite, architecture, cache_dir, repositories, keyrings, downloader)
+            result[(suite, architecture)] = lock_packages(packages, cache=cache)
+        return result
+    host_target = get_host_target()
+    sources_index = None
+    # apt_pkg configuration is process-wide, so targets are resolved one after another
+    for suite, architecture in targets:
+        if (suite, architecture) == host_target:
+            result[(suite, architecture)] = lock_packages(packages)
+        else:
+            logging.info(f"Resolving packages for {suite}/{architecture} ...")
+            sources_index = sources_index or SourcesIndex()
+            with open_target_cache(get_target_rootdir(cache_dir, suite, architecture),
+                                   get_target_sources(suite, architecture, sources_index), architecture,
+                                   apt_update_max_age) as cache:
+                result[(suite, architecture)] = lock_packages(packages, cache=cache)
     return result
 
 
-def download_package(package, dest_dir):
-    version = get_latest_version(package)
-    filename = os.path.basename(version.filename)
-    filepath = os.path.join(dest_dir, filename)
+def write_lock_file(filename, entries):
+    with open(filename, "w") as fp:
+        yaml.safe_dump({"packages": entries}, fp, default_flow_style=False, sort_keys=False)
+
+
+def read_lock_file(filename, target=None):
+    """The lock entries of a single target. From a lock file with several targets, as build_repository writes them,
+    this is the given target, or the only one it has, or the host's."""
+    locked_targets = read_targets_lock_file(filename, target)
+    if target is None and len(locked_targets) == 1:
+        return next(iter(locked_targets.values()))
+    target = target or get_host_target()
+    if target not in locked_targets:
+        raise Exception(f"Lock file {filename} has no packages for {target[0]}/{target[1]}, only for "
+                        f"{', '.join(f'{s}/{a}' for s, a in sorted(locked_targets))}")
+    return locked_targets[target]
+
+
+def dump_locked_targets(locked_targets):
+    return [
+        {"suite": suite, "architecture": architecture, "packages": entries}
+        for (suite, architecture), entries in sorted(locked_targets.items())
+    ]
+
+
+def load_locked_targets(dumped_targets):
+    return {(t["suite"], t["architecture"]): t["packages"] for t in dumped_targets}
+
+
+def write_targets_lock_file(filename, locked_targets):
+    with open(filename, "w") as fp:
+        yaml.safe_dump({"targets": dump_locked_targets(locked_targets)}, fp, default_flow_style=False, sort_keys=False)
+
+
+def read_targets_lock_file(filename, default_target):
+    with open(filename, "r") as fp:
+        lock = yaml.safe_load(fp)
+    if "targets" not in lock:
+        return {default_target: lock["packages"]}
+    return load_locked_targets(lock["targets"])
+
+
+def get_entry_download(entry, dest_dir, hash_cache=None, store=None):
+    filepath = os.path.join(dest_dir, entry["filename"])
     if os.path.isfile(filepath):
-        with open(filepath, "rb") as fp:
-            # noinspection PyTypeChecker
-            sha256hash = file_digest(fp, hashlib.sha256).hexdigest()
-        if sha256hash == version.sha256:
-            logging.info(f"Package {filename} already exists, skipping.")
-            return
-    version.fetch_binary(dest_dir)
+        hexdigests, _ = hash_file(filepath, {"sha256": hashlib.sha256}, hash_cache)
+        if hexdigests["sha256"] == entry["sha256"]:
+            logging.info(f"Package {entry['filename']} already exists, skipping.")
+            metrics.add("download_skipped_files")
+            if store is not None:
+                store.add(filepath, entry["sha256"])
+            return None
+    if store is not None:
+        if store.has(entry["sha256"]):
+            logging.info(f"Package {entry['filename']} found in the package store, skipping.")
+            metrics.add("download_skipped_files")
+            return None
+        filepath = store.prepare(entry["sha256"])
+    if not entry["uri"]:
+        raise Exception(f"No download URI found for package {entry['package']} {entry['version']}")
+    return entry["uri"], filepath, entry["sha256"]
+
+
+def get_package_download(package, dest_dir, hash_cache=None, latest_versions=None):
+    return get_entry_download(get_lock_entry(package, get_latest_version(package, latest_versions)),
+                              dest_dir, hash_cache)
+
+
+def download_package(package, dest_dir, downloader=None, hash_cache=None):
+    download = get_package_download(package, dest_dir, hash_cache)
+    if download is not None:
+        (downloader or Downloader()).download(*download)
+
+
+def download_locked_targets(targets, downloader=None, hash_cache=None, store=None):
+    """Download the lock entries of several (entries, dest_dir) targets, fetching each distinct file only once."""
+    downloads = {}
+    duplicates = []
+    for entries, dest_dir in targets:
+        for entry in entries:
+            download = get_entry_download(entry, dest_dir, hash_cache, store)
+            if download is None:
+                continue
+            uri, filepath, sha256 = download
+            if sha256 in downloads:
+                if downloads[sha256][1] != filepath:
+                    duplicates.append((downloads[sha256][1], filepath))
+            else:
+                downloads[sha256] = download
+    (downloader or Downloader()).download_all(downloads.values())
+    for src, dst in duplicates:
+        link_file(src, dst)
+    if store is not None:
+        for entries, dest_dir in targets:
+            store.register_root(dest_dir)
+            for entry in entries:
+                store.link(entry["sha256"], os.path.join(dest_dir, entry["filename"]), hash_cache)
+
 
+def download_locked_packages(entries, dest_dir, downloader=None, hash_cache=None, store=None):
+    download_locked_targets([(entries, dest_dir)], downloader, hash_cache, store)
 
-def download_packages_with_dependencies(packages, dest_dir):
-    packages = [pd for p in packages for pd in get_package_with_dependencies(p)]
-    for package in set(packages):
-        download_package(package, dest_dir)
 
+def download_packages_with_dependencies(packages, dest_dir, downloader=None, hash_cache=None, lock_file=None,
+                                        store=None, cache=None):
+    entries = lock_packages(packages, cache=cache)
+    if lock_file:
+        write_lock_file(lock_file, entries)
+    download_locked_packages(entries, dest_dir, downloader, hash_cache, store)
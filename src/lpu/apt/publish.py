@@ -0,0 +1,75 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import shutil
+
+AT_FDCWD = -100
+RENAME_EXCHANGE = 1 << 1
+
+# Files of a dist directory that are always regenerated when it is published, and so are not carried over into the
+# staging directory
+release_files = {"Release", "Release.gpg", "InRelease"}
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+
+def rename_exchange(a, b):
+    """Atomically swap two paths with renameat2(RENAME_EXCHANGE)."""
+    renameat2 = getattr(_libc, "renameat2", None)
+    if renameat2 is None:
+        raise OSError(errno.ENOSYS, "renameat2 is not available")
+    if renameat2(AT_FDCWD, os.fsencode(a), AT_FDCWD, os.fsencode(b), RENAME_EXCHANGE) != 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e), a, None, b)
+
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno not in {errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.EMLINK}:
+            raise
+        shutil.copy2(src, dst)
+
+
+def get_staging_dir(dist_dir):
+    return os.path.join(os.path.dirname(dist_dir), f".{os.path.basename(dist_dir)}.staging")
+
+
+def stage_dist_dir(dist_dir):
+    """Create a staging copy of dist_dir, hardlinking all files but the Release files, to build the next version in.
+
+    Index files in the staging directory must be replaced, never written in place, as they share inodes with the
+    published ones.
+    """
+    staging_dir = get_staging_dir(dist_dir)
+    if os.path.lexists(staging_dir):
+        shutil.rmtree(staging_dir)
+    if os.path.isdir(dist_dir):
+        shutil.copytree(dist_dir, staging_dir, symlinks=True, copy_function=link_or_copy,
+                        ignore=lambda d, names: release_files & set(names) if d == dist_dir else set())
+    else:
+        os.makedirs(staging_dir)
+    return staging_dir
+
+
+def publish_dist_dir(staging_dir, dist_dir):
+    """Replace dist_dir with staging_dir, atomically where the kernel and filesystem support it."""
+    if not os.path.isdir(dist_dir):
+        os.rename(staging_dir, dist_dir)
+        return
+    try:
+        rename_exchange(staging_dir, dist_dir)
+    except OSError as e:
+        if e.errno not in {errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP}:
+            raise
+        logging.warning(f"Could not atomically exchange {staging_dir} and {dist_dir} ({e}), renaming instead")
+        old_dir = f"{staging_dir}.old"
+        if os.path.lexists(old_dir):
+            shutil.rmtree(old_dir)
+        os.rename(dist_dir, old_dir)
+        os.rename(staging_dir, dist_dir)
+        staging_dir = old_dir
+    shutil.rmtree(staging_dir)
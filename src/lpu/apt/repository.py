@@ -1,20 +1,31 @@
 #!/usr/bin/env python3
 import datetime
+import functools
 import hashlib
+import io
 import logging
 import os.path
+import re
+import shutil
 import string
-import subprocess
-
-# noinspection PyUnresolvedReferences
-import apt.cache  # TODO: Figure out whether we have python3-apt, if not, call apt install using subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import secrets
-from lpu.apt.packages import download_packages_with_dependencies
-from lpu.common import hash_files, walk_files, Config, load_yaml, load_text_lines, single, get_codename, \
-    get_dpkg_architecture
-from lpu.gpg import gpg_sign, gpg_show_keys, get_secret_key_ids, gpg_import, gpg_list_keys, gpg_gen_key, \
-    gpg_export_secret_key, gpg_export_key
+from lpu.apt.debfile import read_control, read_contents, parse_control, format_control, order_packages_fields
+from lpu.apt.manifest import get_build_manifest, get_files_state
+from lpu.apt.packages import lock_targets, download_locked_targets, write_targets_lock_file, \
+    read_targets_lock_file, get_targets_lists_state, dump_locked_targets, load_locked_targets
+from lpu.apt.publish import stage_dist_dir, publish_dist_dir
+from lpu.apt.version import version_compare
+from lpu.common import file_multi_digest, hash_file, hash_files_multi, walk_files, Config, load_yaml, \
+    load_text_lines, single, get_codename, get_dpkg_architecture, get_hash_cache, get_content_cache, \
+    get_hash_engine
+from lpu.compression import compress, compressors
+from lpu.download import Downloader
+from lpu.store import get_package_store, link_file
+from lpu.gpg import GpgSession, get_secret_key_ids
+from lpu.metrics import metrics
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -22,42 +33,259 @@ logging.getLogger("urllib3").setLevel(logging.WARNING)
 
 
 # region dpt/dpkg functions
-def generate_packages_file(root_dir, architecture_dir, package_files_dir):
-    try:
-        subprocess.check_output(f"dpkg-scanpackages --multiversion {os.path.relpath(package_files_dir, root_dir)} | "
-                                f"tee {os.path.relpath(architecture_dir, root_dir)}/Packages | "
-                                f"gzip -9c > {os.path.relpath(architecture_dir, root_dir)}/Packages.gz",
-                                stderr=subprocess.STDOUT,
-                                shell=True,
-                                cwd=root_dir)
-    except subprocess.CalledProcessError as e:
-        print(e, e.stdout)
-
-
 release_hashes = {
     "MD5Sum": hashlib.md5,
     "SHA1": hashlib.sha1,
-    "SHA256": hashlib.sha256
+    "SHA256": hashlib.sha256,
+    "SHA512": hashlib.sha512,
+}
+
+
+# Hashes index files are published under in by-hash directories, apt requests them by the strongest hash listed in the
+# Release file
+by_hash_algorithms = ["SHA256", "SHA512"]
+
+packages_hashes = {
+    "MD5sum": hashlib.md5,
+    "SHA1": hashlib.sha1,
+    "SHA256": hashlib.sha256,
 }
 
 
-def generate_release_file(dist_dir, component, architecture, component_dir, **release_meta):
+def get_package_stanza(filename, root_dir, hash_cache=None, stanza_cache=None, hashed=None):
+    hexdigests, size = hashed or hash_file(filename, packages_hashes, hash_cache)
+    control = stanza_cache.get(hexdigests["SHA256"]) if stanza_cache is not None else None
+    if control is None:
+        try:
+            control = read_control(filename)
+        except Exception as e:
+            raise Exception(f"Failed to read control data from {filename}: {e}") from e
+        if stanza_cache is not None:
+            stanza_cache.put(hexdigests["SHA256"], control)
+    fields = parse_control(control)
+    fields.update({"Filename": os.path.relpath(filename, root_dir), "Size": str(size), **hexdigests})
+    return order_packages_fields(fields)
+
+
+def write_index_file(filename, content, hash_cache=None, by_hash=False):
+    # Index files are replaced rather than overwritten, so readers never see a partially written file and by-hash
+    # and staged hardlinks of the previous version stay intact
+    with open(f"{filename}.tmp", "wb") as fp:
+        fp.write(content)
+    os.replace(f"{filename}.tmp", filename)
+    if hash_cache is not None or by_hash:
+        digestobjs, _ = file_multi_digest(io.BytesIO(content), release_hashes)
+        if hash_cache is not None:
+            hash_cache.put(filename, {digestobj.name: digestobj.hexdigest() for digestobj in digestobjs.values()})
+        if by_hash:
+            for name in by_hash_algorithms:
+                by_hash_file = os.path.join(os.path.dirname(filename), "by-hash", name, digestobjs[name].hexdigest())
+                if not os.path.isfile(by_hash_file):
+                    os.makedirs(os.path.dirname(by_hash_file), exist_ok=True)
+                    link_file(filename, by_hash_file)
+
+
+def write_compressed_index_file(filename, content, extension, level, hash_cache=None, by_hash=False):
+    write_index_file(f"{filename}.{extension}", compress(content, extension, level), hash_cache, by_hash)
+
+
+def write_index_files(filename, content, compression, hash_cache=None, by_hash=False):
+    for extension in compressors:
+        if extension not in compression and os.path.isfile(f"{filename}.{extension}"):
+            os.remove(f"{filename}.{extension}")
+    with ThreadPoolExecutor(max_workers=len(compression) + 1) as executor:
+        futures = [
+            executor.submit(write_compressed_index_file, filename, content, extension, level, hash_cache, by_hash)
+            for extension, level in compression.items()
+        ]
+        futures.append(executor.submit(write_index_file, filename, content, hash_cache, by_hash))
+        for future in futures:
+            future.result()
+
+
+def iter_package_files(package_files_dir, exclude=None):
+    return (f for f in sorted(walk_files(package_files_dir)) if f.endswith(".deb") and not (exclude and f in exclude))
+
+
+def generate_packages_file(root_dir, architecture_dir, package_files_dir, hash_cache=None, stanza_cache=None,
+                           compression=None, by_hash=False, hash_engine=None, exclude=None):
+    stanzas = [
+        get_package_stanza(f, root_dir, hash_cache, stanza_cache, (hexdigests, size))
+        for hexdigests, size, f in hash_files_multi(iter_package_files(package_files_dir, exclude),
+                                                    packages_hashes, hash_cache, hash_engine)
+    ]
+    stanzas.sort(key=lambda stanza: stanza["Package"])
+    content = "".join(format_control(stanza) + "\n" for stanza in stanzas).encode()
+    write_index_files(os.path.join(architecture_dir, "Packages"), content,
+                      {"gz": 9} if compression is None else compression, hash_cache, by_hash)
+
+
+def generate_contents_file(component_dir, architecture, package_files_dir, hash_cache=None, contents_cache=None,
+                           executor=None, by_hash=False, exclude=None):
+    if executor is None:
+        with ProcessPoolExecutor() as executor:
+            return generate_contents_file(component_dir, architecture, package_files_dir, hash_cache, contents_cache,
+                                          executor, by_hash, exclude)
+    locations = {}
+
+    def _add_locations(name, files):
+        for path in files:
+            locations.setdefault(path, set()).add(name)
+
+    # File lists are cached by package checksum, only packages not seen before are extracted
+    pending = []
+    for f in iter_package_files(package_files_dir, exclude):
+        hexdigests, _ = hash_file(f, {"sha256": hashlib.sha256}, hash_cache)
+        cached = contents_cache.get(hexdigests["sha256"]) if contents_cache is not None else None
+        if cached is None:
+            pending.append((f, hexdigests["sha256"], executor.submit(read_contents, f)))
+        else:
+            name, *files = cached.split("\n")
+            _add_locations(name, files)
+    for f, sha256, future in pending:
+        try:
+            name, files = future.result()
+        except Exception as e:
+            raise Exception(f"Failed to read the file list of {f}: {e}") from e
+        if contents_cache is not None:
+            contents_cache.put(sha256, "\n".join([name, *files]))
+        _add_locations(name, files)
+
+    content = "".join(f"{path:<55} {','.join(sorted(names))}\n" for path, names in sorted(locations.items()))
+    write_compressed_index_file(os.path.join(component_dir, f"Contents-{architecture}"), content.encode(), "gz", 9,
+                                hash_cache, by_hash)
+
+
+retention_policies = ["all", "latest", "locked"]
+
+pool_filename_regex = re.compile(r"^(?P<package>[^_]+)_(?P<version>[^_]+)_(?P<architecture>[^_]+)\.deb$")
+
+
+def get_pool_file_version(filename):
+    """The package, version and architecture of a package file, from its control data, as pool file names omit the
+    epoch of the version."""
+    fields = parse_control(read_control(filename))
+    return fields["Package"], fields["Version"], fields["Architecture"]
+
+
+def select_pool_files_to_prune(package_files_dir, entries, policy, keep_versions=1):
+    """The package files of a pool that the retention policy does not keep. Locked packages are always kept, and
+    with the latest policy count towards the keep_versions newest versions of their package."""
+    files = list(iter_package_files(package_files_dir))
+    keep = {entry["filename"] for entry in entries}
+    if policy == "latest":
+        locked_versions = {entry["filename"]: entry["version"] for entry in entries}
+        package_files = {}
+        for f in files:
+            match = pool_filename_regex.match(os.path.basename(f))
+            if match:
+                package, architecture = match.group("package"), match.group("architecture")
+            else:
+                package, _, architecture = get_pool_file_version(f)
+            package_files.setdefault((package, architecture), {})[os.path.basename(f)] = f
+        for entry in entries:
+            package_files.setdefault((entry["package"], entry["architecture"]), {}).setdefault(entry["filename"])
+        for candidates in package_files.values():
+            if len(candidates) <= keep_versions:
+                keep.update(candidates)
+                continue
+            # Only the control data has the epoch, which file names leave out
+            versions = {filename: locked_versions.get(filename) or get_pool_file_version(f)[1]
+                        for filename, f in candidates.items()}
+            by_version = functools.cmp_to_key(lambda a, b: version_compare(versions[a], versions[b]))
+            keep.update(sorted(versions, key=by_version, reverse=True)[:keep_versions])
+    elif policy != "locked":
+        raise ValueError(f"Unknown retention policy: {policy}")
+    return [f for f in files if os.path.basename(f) not in keep]
+
+
+def remove_pool_files(files, dist_dir, publish_dir):
+    """Remove pruned package files, given by their path in the live pool of dist_dir, from the pool of publish_dir,
+    which is either dist_dir itself or a staged copy hardlinking the same files. Returns the bytes reclaimed. Files
+    with other links, in the package store or the pools of other suites, reclaim nothing."""
+    own_links = 1 if publish_dir == dist_dir else 2
+    reclaimed = 0
+    for f in files:
+        st = os.lstat(f)
+        logging.info(f"Pruning {f} ({st.st_size} bytes)")
+        os.remove(os.path.join(publish_dir, os.path.relpath(f, dist_dir)))
+        if st.st_nlink <= own_links:
+            reclaimed += st.st_size
+    metrics.add("pruned_files", len(files))
+    metrics.add("reclaimed_bytes", reclaimed)
+    return reclaimed
+
+
+# Files listed in Release files, by basename, optionally compressed. Anything else found in the component directory
+# is not published.
+release_index_file_regex = re.compile(
+    r"^(?:Packages|Sources|Release|Index|(?:Contents|Translation|Commands|Components|icons)-[^/]+?)"
+    r"(?:\.(?:gz|xz|zst|bz2|lzma))?$"
+)
+
+
+def iter_index_files(directory):
+    """Index files under directory, in a deterministic order, leaving out by-hash directories."""
+    with os.scandir(directory) as it:
+        entries = sorted(it, key=lambda e: e.name)
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            if entry.name != "by-hash":
+                yield from iter_index_files(entry.path)
+        elif entry.is_file() and release_index_file_regex.match(entry.name):
+            yield entry.path
+
+
+def generate_release_file(dist_dir, component, architecture, component_dir, hash_cache=None, codename=None,
+                          by_hash=False, hash_engine=None, **release_meta):
+    if isinstance(architecture, (list, tuple)):
+        architecture = " ".join(architecture)
     lines = [
         *[f"{k}: {v}" for k, v in release_meta.items()],
         f"Component: {component}",
-        f"Codename: {get_codename()}",
+        f"Codename: {codename or get_codename()}",
         f'Architectures: {architecture}',
-        f'Date: {datetime.datetime.now().astimezone().strftime("%a, %d %b %Y %H:%M:%S %z")}'
+        f'Date: {datetime.datetime.now().astimezone().strftime("%a, %d %b %Y %H:%M:%S %z")}',
+        *(["Acquire-By-Hash: yes"] if by_hash else []),
     ]
-    for name, digest in release_hashes.items():
-        lines.append(f"{name}:")
-        for hexdigest, size, f in hash_files(walk_files(component_dir), digest):
-            f = os.path.relpath(f, dist_dir)
-            if f in {"Release", "Release.gpg", "InRelease"}:
-                continue
-            lines.append(f" {hexdigest} {size:16} {f}")
-    with open(os.path.join(dist_dir, "Release"), "w") as fp:
-        fp.write("\n".join(lines) + "\n")
+    # Files are hashed once, their lines go to a temporary file per hash section, so memory use does not depend on the
+    # number of index files
+    sections = {name: tempfile.TemporaryFile("w+") for name in release_hashes}
+    try:
+        for hexdigests, size, f in hash_files_multi(iter_index_files(component_dir), release_hashes, hash_cache,
+                                                    hash_engine):
+            for name, section in sections.items():
+                section.write(f" {hexdigests[name]} {size:16} {os.path.relpath(f, dist_dir)}\n")
+        with open(os.path.join(dist_dir, "Release.tmp"), "w") as fp:
+            fp.write("\n".join(lines) + "\n")
+            for name, section in sections.items():
+                fp.write(f"{name}:\n")
+                section.seek(0)
+                shutil.copyfileobj(section, fp)
+    finally:
+        for section in sections.values():
+            section.close()
+    os.replace(os.path.join(dist_dir, "Release.tmp"), os.path.join(dist_dir, "Release"))
+
+
+def read_release_hashes(release_file):
+    """The hexdigests of all files listed in a Release file."""
+    hexdigests = set()
+    if os.path.isfile(release_file):
+        with open(release_file, "r") as fp:
+            for line in fp:
+                if line.startswith(" "):
+                    hexdigests.add(line.split()[0])
+    return hexdigests
+
+
+def prune_by_hash(component_dir, keep_hexdigests):
+    """Remove by-hash files that are not listed in any of the Release files clients may still be using."""
+    for root, dirs, files in os.walk(component_dir):
+        if os.path.basename(os.path.dirname(root)) == "by-hash":
+            for f in files:
+                if f not in keep_hexdigests:
+                    os.remove(os.path.join(root, f))
 
 
 # endregion
@@ -67,16 +295,15 @@ def generate_password(length, alphabet=string.ascii_letters + string.digits):
     return ''.join(secrets.choice(alphabet) for _ in range(length))
 
 
-def sign_release_file(repo_dir, key_id, key_passphrase):
-    gpg_sign(key_id, key_passphrase,
-             os.path.join(repo_dir, "Release"), os.path.join(repo_dir, "Release.gpg"),
-             detached=True)
-    gpg_sign(key_id, key_passphrase,
-             os.path.join(repo_dir, "Release"), os.path.join(repo_dir, "InRelease"))
+def sign_release_file(repo_dir, key_id, key_passphrase, gpg=None):
+    (gpg or GpgSession()).sign_detached_and_clearsigned(
+        key_id, key_passphrase,
+        os.path.join(repo_dir, "Release"), os.path.join(repo_dir, "Release.gpg"), os.path.join(repo_dir, "InRelease"))
 
 
 # endregion
-def generate_key(config):
+def generate_key(config, gpg=None):
+    gpg = gpg or GpgSession()
     # Should never happen, if argpase did its job
     assert not (config.is_present('passphrase_file') and config.is_present('passphrase'))
     if config.is_present('passphrase'):
@@ -93,58 +320,249 @@ def generate_key(config):
 
     key_file_exists = config['key_file'] and os.path.isfile(config['key_file'])
     if config.is_present('key_id'):
-        key_id_exists = config['key_id'] in get_secret_key_ids(gpg_list_keys(secret=True))
+        key_id_exists = config['key_id'] in get_secret_key_ids(gpg.list_keys(secret=True))
         if not key_id_exists:
             if key_file_exists:
-                if config['key_id'] not in get_secret_key_ids(gpg_show_keys(config['key_file'])):
+                if config['key_id'] not in get_secret_key_ids(gpg.show_keys(config['key_file'])):
                     raise Exception(f"Key {config['key_id']} was fount neither in the keyring, "
                                     f"nor in the existing file {config['key_file']}.")
-                gpg_import(config['key_file'])
+                gpg.import_key(config['key_file'])
             else:
                 raise Exception(
                     f"Key {config['key_id']} not found in keyring, and no key file specified to import from.")
         key_id = config['key_id']
     elif key_file_exists:
         try:
-            key_id = single(get_secret_key_ids(gpg_show_keys(config['key_file'])))
+            key_id = single(get_secret_key_ids(gpg.show_keys(config['key_file'])))
         except ValueError:
             raise Exception(f"The file {config['key_file']} contains more than one secret key, and no key id is "
                             f"specified")
-        gpg_import(config['key_file'])
+        if key_id not in get_secret_key_ids(gpg.list_keys(secret=True)):
+            gpg.import_key(config['key_file'])
     else:
         os.makedirs(os.path.dirname(config['key_file']), exist_ok=True)
-        key_id = gpg_gen_key(**load_yaml(config['key_metadata']), Passphrase=passphrase)
-        gpg_export_secret_key(key_id, config['key_file'])
+        key_id = gpg.gen_key(**load_yaml(config['key_metadata']), Passphrase=passphrase)
+        gpg.export_secret_key(key_id, config['key_file'])
 
     return key_id, passphrase
 
 
 def build_repository(config):
+    hash_cache = get_hash_cache(config)
+    try:
+        with get_hash_engine(config) as hash_engine:
+            _build_repository(config, hash_cache, hash_engine)
+    finally:
+        if hash_cache is not None:
+            hash_cache.close()
+
+
+def _build_repository(config, hash_cache, hash_engine):
     output_dir: str = config['output_dir']
-    dist_dir = os.path.join(output_dir, "dists", get_codename())
     component = config['component']
-    component_dir = os.path.join(dist_dir, component)
-    architecture = get_dpkg_architecture()["DEB_HOST_ARCH"]
-    architecture_dir = os.path.join(component_dir, f"binary-{architecture}")
-    package_files_dir = os.path.join(dist_dir, "pool", component, architecture)
+    suites = config['suites'] or [get_codename()]
+    architectures = config['architectures'] or [get_dpkg_architecture()["DEB_HOST_ARCH"]]
+    targets = [(suite, architecture) for suite in suites for architecture in architectures]
+
+    def _dist_dir(suite):
+        return os.path.join(output_dir, "dists", suite)
 
-    os.makedirs(dist_dir, exist_ok=True)
-    os.makedirs(component_dir, exist_ok=True)
-    os.makedirs(architecture_dir, exist_ok=True)
-    os.makedirs(package_files_dir, exist_ok=True)
+    def _architecture_dir(suite, architecture):
+        return os.path.join(_dist_dir(suite), component, f"binary-{architecture}")
 
-    packages = set(p for pa in config['packages'] for p in load_text_lines(pa))
-    download_packages_with_dependencies(packages, package_files_dir)
+    def _package_files_dir(suite, architecture):
+        return os.path.join(_dist_dir(suite), "pool", component, architecture)
 
-    generate_packages_file(output_dir, architecture_dir, package_files_dir)
+    for suite, architecture in targets:
+        os.makedirs(_architecture_dir(suite, architecture), exist_ok=True)
+        os.makedirs(_package_files_dir(suite, architecture), exist_ok=True)
+
+    downloader = Downloader(jobs=config["jobs"], jobs_per_host=config["jobs_per_host"], retries=config["retries"],
+                            hash_cache=hash_cache)
+    store = get_package_store(config)
+    manifest = get_build_manifest(config)
+    if config.is_present('from_lock'):
+        locked_targets = read_targets_lock_file(config['from_lock'], targets[0])
+        missing_targets = set(targets) - set(locked_targets)
+        if missing_targets:
+            raise Exception(f"Lock file {config['from_lock']} has no packages for "
+                            f"{', '.join(f'{s}/{a}' for s, a in sorted(missing_targets))}")
+    else:
+        packages = sorted(set(p for pa in config['packages'] for p in load_text_lines(pa)))
 
+        resolver = config['resolver']
+        repositories = load_yaml(config.get('repositories'))
+
+        def _resolve_inputs():
+            return {
+                "packages": packages,
+                "targets": targets,
+                # Repository indices are fetched while resolving, so index resolutions are never reused
+                "lists": get_targets_lists_state(targets, config['cache_dir'], config['apt_update_max_age'])
+                if resolver == "apt" else None,
+            }
+
+        resolve_inputs = _resolve_inputs()
+        if resolve_inputs["lists"] is not None and manifest.is_current("resolve", resolve_inputs):
+            locked_targets = load_locked_targets(manifest.get_outputs("resolve"))
+        else:
+            with metrics.stage("resolve"):
+                locked_targets = lock_targets(packages, targets, config['cache_dir'], config['apt_update_max_age'],
+                                              resolver, repositories, downloader)
+            manifest.update("resolve", _resolve_inputs(), dump_locked_targets(locked_targets))
+        if config['lock_file']:
+            write_targets_lock_file(config['lock_file'], locked_targets)
+
+    def _download_inputs():
+        return {
+            "packages": dump_locked_targets({target: locked_targets[target] for target in targets}),
+            "pool": get_files_state([_package_files_dir(*target) for target in targets], output_dir),
+        }
+
+    if not manifest.is_current("download", _download_inputs()):
+        with metrics.stage("download"):
+            download_locked_targets(
+                [(locked_targets[target], _package_files_dir(*target)) for target in targets],
+                downloader, hash_cache, store)
+        manifest.update("download", _download_inputs())
+
+    # Package files the retention policy drops are left out of the new indices, but stay in the live pool until
+    # the indices that no longer list them are published
+    pruned_files = {}
+    if config['retention_policy'] != "all":
+        with metrics.stage("prune"):
+            for target in targets:
+                files = select_pool_files_to_prune(_package_files_dir(*target), locked_targets[target],
+                                                   config['retention_policy'], config['keep_versions'])
+                if files:
+                    pruned_files[target] = set(files)
+
+    index_compression = load_yaml(config['index_compression'])
+    by_hash = bool(config['by_hash'])
     release_metadata = load_yaml(config['release_metadata'])
+    public_key_file = os.path.join(output_dir, config['public_key_export'])
+
+    def _packages_inputs(suite, architecture):
+        return {
+            "compression": index_compression,
+            "by_hash": by_hash,
+            "pool": get_files_state([_package_files_dir(suite, architecture)], output_dir),
+            "index": get_files_state([_architecture_dir(suite, architecture)], output_dir),
+        }
+
+    def _contents_inputs(suite, architecture):
+        return {
+            "by_hash": by_hash,
+            "pool": get_files_state([_package_files_dir(suite, architecture)], output_dir),
+            "index": get_files_state([os.path.join(_dist_dir(suite), component, f"Contents-{architecture}.gz")],
+                                     output_dir),
+        }
+
+    def _sign_inputs():
+        return {
+            "component": component,
+            "suites": suites,
+            "architectures": architectures,
+            "release_metadata": release_metadata,
+            "by_hash": by_hash,
+            "key": {
+                "key_id": config['key_id'],
+                "key_file": get_files_state([config['key_file']]) if config['key_file'] else None,
+                "key_metadata": load_yaml(config['key_metadata']),
+                "passphrase_file": get_files_state([config['passphrase_file']]),
+                "gnupg_home": config['gnupg_home'],
+            },
+            "index": get_files_state([os.path.join(_dist_dir(suite), component) for suite in suites], output_dir),
+            "release": get_files_state([os.path.join(_dist_dir(suite), f) for suite in suites
+                                        for f in ["Release", "Release.gpg", "InRelease"]], output_dir),
+            "public_key": get_files_state([public_key_file], output_dir),
+        }
+
+    pending_targets = [
+        (suite, architecture)
+        for suite, architecture in targets
+        if (suite, architecture) in pruned_files or
+        not manifest.is_current(f"packages:{suite}/{architecture}", _packages_inputs(suite, architecture))
+    ]
+    pending_contents_targets = [
+        (suite, architecture)
+        for suite, architecture in targets
+        if config['contents'] and ((suite, architecture) in pruned_files or
+                                   not manifest.is_current(f"contents:{suite}/{architecture}",
+                                                           _contents_inputs(suite, architecture)))
+    ]
+    if not pending_targets and not pending_contents_targets and manifest.is_current("sign", _sign_inputs()):
+        return
+
+    # Every suite gets a new Release file, so every suite is staged and published
+    with metrics.stage("stage"):
+        publish_dirs = {
+            suite: stage_dist_dir(_dist_dir(suite)) if config['atomic_publish'] else _dist_dir(suite)
+            for suite in suites
+        }
+
+    with metrics.stage("packages"):
+        control_cache = get_content_cache(config, "control")
+        try:
+            with ThreadPoolExecutor() as executor:
+                futures = [
+                    executor.submit(generate_packages_file, output_dir,
+                                    os.path.join(publish_dirs[suite], component, f"binary-{architecture}"),
+                                    _package_files_dir(suite, architecture), hash_cache, control_cache,
+                                    index_compression, by_hash, hash_engine, pruned_files.get((suite, architecture)))
+                    for suite, architecture in pending_targets
+                ]
+                for future in futures:
+                    future.result()
+        finally:
+            control_cache.close()
+
+    if pending_contents_targets:
+        with metrics.stage("contents"):
+            contents_cache = get_content_cache(config, "contents")
+            try:
+                with ProcessPoolExecutor() as executor:
+                    for suite, architecture in pending_contents_targets:
+                        generate_contents_file(os.path.join(publish_dirs[suite], component), architecture,
+                                               _package_files_dir(suite, architecture), hash_cache, contents_cache,
+                                               executor, by_hash, pruned_files.get((suite, architecture)))
+            finally:
+                contents_cache.close()
+
+    with metrics.stage("release"):
+        with GpgSession(config['gnupg_home'] or os.path.join(config['cache_dir'], "gnupg")) as gpg:
+            key_id, passphrase = generate_key(config, gpg)
 
-    generate_release_file(dist_dir, component, architecture, component_dir, **release_metadata)
+            for suite in suites:
+                previous_hexdigests = read_release_hashes(os.path.join(_dist_dir(suite), "Release"))
+                generate_release_file(publish_dirs[suite], component, architectures,
+                                      os.path.join(publish_dirs[suite], component), hash_cache, suite, by_hash,
+                                      hash_engine, **release_metadata)
+                if by_hash:
+                    # Clients may still be fetching the indices of the previous Release file
+                    prune_by_hash(os.path.join(publish_dirs[suite], component),
+                                  previous_hexdigests |
+                                  read_release_hashes(os.path.join(publish_dirs[suite], "Release")))
 
-    key_id, passphrase = generate_key(config)
+                sign_release_file(publish_dirs[suite], key_id, passphrase, gpg)
 
-    sign_release_file(dist_dir, key_id, passphrase)
+            gpg.export_key(key_id, public_key_file)
 
-    gpg_export_key(key_id, os.path.join(output_dir, config['public_key_export']))
+    with metrics.stage("publish"):
+        for suite in suites:
+            for architecture in architectures:
+                if (suite, architecture) in pruned_files:
+                    reclaimed = remove_pool_files(sorted(pruned_files[(suite, architecture)]), _dist_dir(suite),
+                                                  publish_dirs[suite])
+                    logging.info(f"Pruned {len(pruned_files[(suite, architecture)])} package file(s) from "
+                                 f"{suite}/{architecture}, reclaiming {reclaimed} bytes")
+            if publish_dirs[suite] != _dist_dir(suite):
+                publish_dist_dir(publish_dirs[suite], _dist_dir(suite))
 
+    if pruned_files:
+        manifest.update("download", _download_inputs())
+    for suite, architecture in pending_targets:
+        manifest.update(f"packages:{suite}/{architecture}", _packages_inputs(suite, architecture))
+    for suite, architecture in pending_contents_targets:
+        manifest.update(f"contents:{suite}/{architecture}", _contents_inputs(suite, architecture))
+    manifest.update("sign", _sign_inputs())
@@ -1,9 +1,12 @@
 import argparse
 
 from lpu.apt.common import update_apt_cache, install_dependencies
-from lpu.apt.repository import build_repository
+from lpu.apt.packages import resolvers
+from lpu.apt.repository import build_repository, retention_policies
 from lpu.apt.sources import install_apt_sources
 from lpu.common import Config
+from lpu.metrics import metrics, emit_report, timing_formats
+from lpu.store import link_modes
 
 config_defaults = {
     "output_dir": "repo",
@@ -15,6 +18,19 @@ config_defaults = {
         "Description": "Offline Repo",
     },
     "component": "main",
+    "jobs": 4,
+    "jobs_per_host": 2,
+    "retries": 3,
+    "cache_dir": "cache",
+    "apt_update_max_age": 0,
+    "resolver": "apt",
+    "link_mode": "hardlink",
+    "retention_policy": "all",
+    "keep_versions": 2,
+    "index_compression": {
+        "gz": 9,
+        "xz": 6,
+    },
     "passphrase_file": "secrets/passphrase",
     "key_file": 'secrets/gpg-secret-key',
     "key_metadata": {
@@ -42,6 +58,16 @@ def main():
                         help="Directory to output the repository files to")
     parser.add_argument("--component",
                         help=f"The repository component (default is '{config_defaults['component']}')")
+    parser.add_argument("--suite",
+                        dest="suites",
+                        action="append",
+                        help="A suite (codename) to build the repository for, may be repeated (default is the host's "
+                             "codename)")
+    parser.add_argument("--architecture",
+                        dest="architectures",
+                        action="append",
+                        help="An architecture to build the repository for, may be repeated (default is the host's "
+                             "architecture)")
     parser.add_argument("--key-id",
                         help="The identifier of the gpg secret key that will be used to sign the repository metadata "
                              "files")
@@ -50,8 +76,25 @@ def main():
                              "metadata files If a new key is generated, it will be exported to this file")
     parser.add_argument("--key-metadata",
                         help="Metadata to be used in key generation. " + yaml_help)
+    parser.add_argument("--gnupg-home",
+                        help="Isolated gpg home directory to keep the signing key in (default is 'gnupg' in the cache "
+                             "directory)")
     parser.add_argument("--release-metadata",
                         help="Metadata to be used for the repository Release file. " + yaml_help)
+    parser.add_argument("--index-compression",
+                        help="Compression formats (gz, xz, zst) and levels to publish index files with, as a mapping "
+                             "of format to level. " + yaml_help)
+    parser.add_argument("--contents",
+                        action="store_true",
+                        help="Also generate a Contents-<architecture> index of the files in each package, for apt-file")
+    parser.add_argument("--by-hash",
+                        action="store_true",
+                        help="Also publish index files under by-hash/<hash>/<digest> and set Acquire-By-Hash in the "
+                             "Release files, so clients never fetch an index that does not match their Release file")
+    parser.add_argument("--atomic-publish",
+                        action="store_true",
+                        help="Build the new version of each dists/<suite> directory next to the published one and "
+                             "swap them atomically once it is complete")
     passphrase_group = parser.add_mutually_exclusive_group()
     passphrase_group.add_argument("--passphrase",
                                   help="Passphrase for the signing key")
@@ -62,23 +105,98 @@ def main():
     parser.add_argument("--no-install-dependencies",
                         action="store_true",
                         help="Do not install packages with dependencies required for the execution of this script")
+    parser.add_argument("-j", "--jobs",
+                        type=int,
+                        help=f"Number of packages to download concurrently (default is {config_defaults['jobs']})")
+    parser.add_argument("--jobs-per-host",
+                        type=int,
+                        help=f"Maximum number of concurrent downloads from a single host "
+                             f"(default is {config_defaults['jobs_per_host']})")
+    parser.add_argument("--retries",
+                        type=int,
+                        help=f"Number of times a failed download is retried (default is {config_defaults['retries']})")
+    parser.add_argument("--cache-dir",
+                        help=f"Directory to keep caches between runs in (default is '{config_defaults['cache_dir']}')")
+    parser.add_argument("--no-hash-cache",
+                        action="store_true",
+                        help="Do not use the on-disk cache of file hashes, hash every file from scratch")
+    parser.add_argument("--hash-jobs",
+                        type=int,
+                        help="Number of files to hash concurrently (default is the number of CPUs)")
+    parser.add_argument("--hash-processes",
+                        action="store_true",
+                        help="Hash files in worker processes instead of threads")
+    parser.add_argument("--resolver",
+                        choices=resolvers,
+                        help="Resolve dependencies with the host's APT cache, or by reading the Packages indices of "
+                             "the configured repositories directly, which needs neither root nor apt "
+                             f"(default is '{config_defaults['resolver']}')")
+    parser.add_argument("--apt-update-max-age",
+                        type=int,
+                        help="Skip 'apt update' if the APT lists were updated less than this many seconds ago "
+                             "(default is 0, always update). With the apt resolver, 'apt update', installing "
+                             "dependencies and adding the repositories to apt run before unchanged stages are "
+                             "skipped, so rebuilding an unchanged repository is only fast with a non-zero max age, "
+                             "--resolver index or --from-lock")
+    parser.add_argument("--store-dir",
+                        help="Directory of a content-addressed package store shared between repositories. Packages "
+                             "are downloaded into it once and linked into the output directory")
+    parser.add_argument("--link-mode",
+                        choices=link_modes,
+                        help=f"How packages are linked from the package store into the output directory "
+                             f"(default is '{config_defaults['link_mode']}')")
+    parser.add_argument("--retention-policy",
+                        choices=retention_policies,
+                        help="Which package files to keep in the pool: all of them, the newest --keep-versions "
+                             "versions of each package, or only the locked ones. Locked packages are always kept "
+                             f"(default is '{config_defaults['retention_policy']}')")
+    parser.add_argument("--keep-versions",
+                        type=int,
+                        help=f"Number of versions of each package kept by the latest retention policy "
+                             f"(default is {config_defaults['keep_versions']})")
+    parser.add_argument("--manifest-file",
+                        help="Where to keep the inputs of the last build, used to skip stages whose inputs did not "
+                             "change (default is a file in the 'manifests' directory of the cache directory)")
+    parser.add_argument("--force-rebuild",
+                        action="store_true",
+                        help="Run every stage of the build, even if its inputs did not change since the last build")
+    parser.add_argument("--lock-file",
+                        help="Write the resolved packages, with exact versions, checksums and URIs, to this lock file")
+    parser.add_argument("--from-lock",
+                        help="Download the packages listed in this lock file, without resolving dependencies or "
+                             "using the APT cache")
+    parser.add_argument("--timings",
+                        choices=timing_formats,
+                        help="Print a report of the time spent in each stage, bytes downloaded and hashed, "
+                             "subprocesses spawned and peak memory use when done")
+    parser.add_argument("--prometheus-textfile",
+                        help="Write the same report in the Prometheus text format to this file, for the node "
+                             "exporter's textfile collector")
     parser.add_argument("--repositories",
-                        help="Repositories to be added to apt before resolving target packages. " + yaml_help)
+                        help="Repositories to be added to apt before resolving target packages, or to read the "
+                             "indices of with the index resolver. " + yaml_help)
     parser.add_argument("packages",
                         help="The packages to include in the repository. Arguments starting with @ will be treated as "
                              "paths to files containing lists of packages",
                         nargs="*")
     config = Config(parser.parse_args(), config_defaults)
-    if not config.is_present("packages"):
+    if not config.is_present("packages") and not config.is_present("from_lock"):
         print("No packages specified to build a repository for")
 
-    update_apt_cache()
+    try:
+        if not config.is_present("from_lock") and config["resolver"] == "apt":
+            with metrics.stage("update_apt_cache"):
+                update_apt_cache(config["apt_update_max_age"])
 
-    install_dependencies(config["no_install_dependencies"])
+            with metrics.stage("install_dependencies"):
+                install_dependencies(config["no_install_dependencies"])
 
-    install_apt_sources(config.get("repositories"))
+            with metrics.stage("install_apt_sources"):
+                install_apt_sources(config.get("repositories"), config["cache_dir"])
 
-    build_repository(config)
+        build_repository(config)
+    finally:
+        emit_report(config)
 
 
 if __name__ == '__main__':
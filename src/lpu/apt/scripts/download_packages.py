@@ -2,12 +2,23 @@ import argparse
 import os
 
 from lpu.apt.common import update_apt_cache, install_dependencies
-from lpu.apt.packages import download_packages_with_dependencies
-from lpu.apt.sources import install_apt_sources
-from lpu.common import Config, load_text_lines
+from lpu.apt.packages import lock_packages, write_lock_file, download_locked_packages, read_lock_file, resolvers, \
+    get_host_target, open_index_cache
+from lpu.apt.sources import install_apt_sources, fetch_repository_keyrings
+from lpu.common import Config, load_text_lines, load_yaml, get_hash_cache
+from lpu.download import Downloader
+from lpu.metrics import metrics, emit_report, timing_formats
+from lpu.store import get_package_store, link_modes
 
 config_defaults = {
     "output_dir": ".",
+    "jobs": 4,
+    "jobs_per_host": 2,
+    "retries": 3,
+    "cache_dir": "cache",
+    "apt_update_max_age": 0,
+    "resolver": "apt",
+    "link_mode": "hardlink",
 }
 yaml_help = (
     "If the argument is -, it is read from stdin, if the argument starts with @, it is treated as path to a "
@@ -24,26 +35,107 @@ def main():
     parser.add_argument("--no-install-dependencies",
                         action="store_true",
                         help="Do not install packages with dependencies required for the execution of this script")
+    parser.add_argument("-j", "--jobs",
+                        type=int,
+                        help=f"Number of packages to download concurrently (default is {config_defaults['jobs']})")
+    parser.add_argument("--jobs-per-host",
+                        type=int,
+                        help=f"Maximum number of concurrent downloads from a single host "
+                             f"(default is {config_defaults['jobs_per_host']})")
+    parser.add_argument("--retries",
+                        type=int,
+                        help=f"Number of times a failed download is retried (default is {config_defaults['retries']})")
+    parser.add_argument("--cache-dir",
+                        help=f"Directory to keep caches between runs in (default is '{config_defaults['cache_dir']}')")
+    parser.add_argument("--no-hash-cache",
+                        action="store_true",
+                        help="Do not use the on-disk cache of file hashes, hash every file from scratch")
+    parser.add_argument("--resolver",
+                        choices=resolvers,
+                        help="Resolve dependencies with the host's APT cache, or by reading the Packages indices of "
+                             "the configured repositories directly, which needs neither root nor apt "
+                             f"(default is '{config_defaults['resolver']}')")
+    parser.add_argument("--apt-update-max-age",
+                        type=int,
+                        help="Skip 'apt update' if the APT lists were updated less than this many seconds ago "
+                             "(default is 0, always update)")
+    parser.add_argument("--store-dir",
+                        help="Directory of a content-addressed package store shared between repositories. Packages "
+                             "are downloaded into it once and linked into the output directory")
+    parser.add_argument("--link-mode",
+                        choices=link_modes,
+                        help=f"How packages are linked from the package store into the output directory "
+                             f"(default is '{config_defaults['link_mode']}')")
+    parser.add_argument("--lock-file",
+                        help="Write the resolved packages, with exact versions, checksums and URIs, to this lock file")
+    parser.add_argument("--from-lock",
+                        help="Download the packages listed in this lock file, without resolving dependencies or "
+                             "using the APT cache")
+    parser.add_argument("--suite",
+                        help="The suite (codename) to resolve packages for with the index resolver, or to read from a "
+                             "lock file with several targets (default is the host's codename)")
+    parser.add_argument("--architecture",
+                        help="The architecture to resolve packages for with the index resolver, or to read from a "
+                             "lock file with several targets (default is the host's architecture)")
+    parser.add_argument("--timings",
+                        choices=timing_formats,
+                        help="Print a report of the time spent in each stage, bytes downloaded and hashed, "
+                             "subprocesses spawned and peak memory use when done")
+    parser.add_argument("--prometheus-textfile",
+                        help="Write the same report in the Prometheus text format to this file, for the node "
+                             "exporter's textfile collector")
     parser.add_argument("--repositories",
-                        help="Repositories to be added to apt before resolving target packages. " + yaml_help)
+                        help="Repositories to be added to apt before resolving target packages, or to read the "
+                             "indices of with the index resolver. " + yaml_help)
     parser.add_argument("packages",
                         help="The packages to download. Arguments starting with @ will be treated as "
                              "paths to files containing lists of packages",
                         nargs="*")
     config = Config(parser.parse_args(), config_defaults)
-    if not config.is_present("packages"):
+    if not config.is_present("packages") and not config.is_present("from_lock"):
         print("No packages specified to download")
 
-    update_apt_cache()
+    hash_cache = None
+    try:
+        if not config.is_present("from_lock") and config["resolver"] == "apt":
+            with metrics.stage("update_apt_cache"):
+                update_apt_cache(config["apt_update_max_age"])
 
-    install_dependencies(config["no_install_dependencies"])
+            with metrics.stage("install_dependencies"):
+                install_dependencies(config["no_install_dependencies"])
 
-    install_apt_sources(config.get("repositories"))
+            with metrics.stage("install_apt_sources"):
+                install_apt_sources(config.get("repositories"), config["cache_dir"])
 
-    output_dir = config["output_dir"]
-    os.makedirs(output_dir, exist_ok=True)
-    packages = set(p for pa in config['packages'] for p in load_text_lines(pa))
-    download_packages_with_dependencies(packages, output_dir)
+        output_dir = config["output_dir"]
+        os.makedirs(output_dir, exist_ok=True)
+        hash_cache = get_hash_cache(config)
+        downloader = Downloader(jobs=config["jobs"], jobs_per_host=config["jobs_per_host"],
+                                retries=config["retries"], hash_cache=hash_cache)
+        store = get_package_store(config)
+        target = None
+        if config.is_present("suite") or config.is_present("architecture"):
+            host_suite, host_architecture = get_host_target()
+            target = (config["suite"] or host_suite, config["architecture"] or host_architecture)
+        if config.is_present("from_lock"):
+            entries = read_lock_file(config["from_lock"], target)
+        else:
+            packages = set(p for pa in config['packages'] for p in load_text_lines(pa))
+            with metrics.stage("resolve"):
+                cache = None
+                if config["resolver"] == "index":
+                    repositories = load_yaml(config.get("repositories"))
+                    cache = open_index_cache(*(target or get_host_target()), config["cache_dir"], repositories,
+                                             fetch_repository_keyrings(repositories, config["cache_dir"]), downloader)
+                entries = lock_packages(packages, cache=cache)
+            if config["lock_file"]:
+                write_lock_file(config["lock_file"], entries)
+        with metrics.stage("download"):
+            download_locked_packages(entries, output_dir, downloader, hash_cache, store)
+    finally:
+        if hash_cache is not None:
+            hash_cache.close()
+        emit_report(config)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,51 @@
+import argparse
+import logging
+
+from lpu.common import Config, get_hash_cache, get_hash_engine
+from lpu.store import PackageStore
+
+config_defaults = {
+    "cache_dir": "cache",
+}
+yaml_help = (
+    "If the argument is -, it is read from stdin, if the argument starts with @, it is treated as path to a "
+    "file, otherwise it is treated as a YAML/JSON string,"
+)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Remove packages no repository links to from a package store")
+    parser.add_argument("-c", "--config",
+                        help="Configuration for this script. " + yaml_help)
+    parser.add_argument("--store-dir",
+                        help="Directory of the content-addressed package store")
+    parser.add_argument("--cache-dir",
+                        help=f"Directory to keep caches between runs in (default is '{config_defaults['cache_dir']}')")
+    parser.add_argument("--no-hash-cache",
+                        action="store_true",
+                        help="Do not use the on-disk cache of file hashes, hash every file from scratch")
+    parser.add_argument("--hash-jobs",
+                        type=int,
+                        help="Number of files to hash concurrently (default is the number of CPUs)")
+    parser.add_argument("-n", "--dry-run",
+                        action="store_true",
+                        help="Only report the packages that would be removed")
+    config = Config(parser.parse_args(), config_defaults)
+    if not config.is_present("store_dir"):
+        parser.error("No package store specified")
+
+    store = PackageStore(config["store_dir"])
+    hash_cache = get_hash_cache(config)
+    try:
+        with get_hash_engine(config) as hash_engine:
+            removed, reclaimed = store.gc(hash_cache, config["dry_run"], hash_engine)
+    finally:
+        if hash_cache is not None:
+            hash_cache.close()
+    logging.info(f"{'Would remove' if config['dry_run'] else 'Removed'} {removed} unreferenced package(s), "
+                 f"{reclaimed} bytes")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,17 @@
+import hashlib
+import json
 import logging
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 
 from lpu.apt.common import update_apt_cache
-from lpu.common import load_yaml, get_codename, get_dpkg_architecture
-from lpu.gpg import get_secret_key_ids, gpg_show_keys, gpg_dearmor
+from lpu.apt.debfile import parse_control
+from lpu.common import load_yaml, get_codename, get_dpkg_architecture, file_digest
+from lpu.download import create_session
+from lpu.gpg import gpg_show_keys, gpg_dearmor
 
 apt_base_dir = "/etc/apt"
 apt_sources_list_file = f"{apt_base_dir}/sources.list"
@@ -14,19 +19,84 @@ apt_gpg_key_base_dir = f"{apt_base_dir}/trusted.gpg.d"
 apt_sources_list_dir = f"{apt_base_dir}/sources.list.d"
 
 
-def install_apt_key(key_url, name):
+def _read_cached_key(cache_dir, name):
+    if cache_dir is None:
+        return None, {}
+    content_file = os.path.join(cache_dir, "keys", f"{name}.asc")
+    meta_file = os.path.join(cache_dir, "keys", f"{name}.json")
+    if not (os.path.isfile(content_file) and os.path.isfile(meta_file)):
+        return None, {}
+    with open(content_file, "rb") as fp:
+        content = fp.read()
+    with open(meta_file, "r") as fp:
+        meta = json.load(fp)
+    if meta.get("sha256") != hashlib.sha256(content).hexdigest():
+        return None, {}
+    return content, meta
+
+
+def _write_cached_key(cache_dir, name, content, meta):
+    if cache_dir is None:
+        return
+    os.makedirs(os.path.join(cache_dir, "keys"), exist_ok=True)
+    with open(os.path.join(cache_dir, "keys", f"{name}.asc"), "wb") as fp:
+        fp.write(content)
+    with open(os.path.join(cache_dir, "keys", f"{name}.json"), "w") as fp:
+        json.dump(meta, fp, indent=2, sort_keys=True)
+
+
+def fetch_apt_key(key_url, name, session=None, cache_dir=None):
+    cached_content, meta = _read_cached_key(cache_dir, name)
+    headers = {}
+    if cached_content is not None and meta.get("url") == key_url:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+    r = (session or requests).get(key_url, headers=headers, timeout=60)
+    if r.status_code == 304:
+        logging.info(f"Key {key_url} not modified since last fetch.")
+        return cached_content, meta, True
+    r.raise_for_status()
+    content = r.content
+    sha256 = hashlib.sha256(content).hexdigest()
+    unchanged = cached_content is not None and meta.get("sha256") == sha256
+    meta = {
+        **(meta if unchanged else {}),
+        "url": key_url,
+        "etag": r.headers.get("ETag"),
+        "last_modified": r.headers.get("Last-Modified"),
+        "sha256": sha256,
+    }
+    return content, meta, unchanged
+
+
+def install_apt_key(key_url, name, session=None, cache_dir=None, fetched=None):
     os.makedirs(apt_gpg_key_base_dir, exist_ok=True)
     key_filename = os.path.join(apt_gpg_key_base_dir, f"{name}.gpg")
 
-    key_content = requests.get(key_url).content
-    upstream_secret_keys = set(get_secret_key_ids(gpg_show_keys(content=key_content)))
-    if os.path.isfile(key_filename):
-        file_secret_keys = set(get_secret_key_ids(gpg_show_keys(filename=key_filename)))
-        if not upstream_secret_keys - file_secret_keys:
-            logging.info(f"Keys from {key_url} already present in {key_filename}. Skipping.")
+    key_content, meta, unchanged = fetched or fetch_apt_key(key_url, name, session, cache_dir)
+    if unchanged and os.path.isfile(key_filename) and meta.get("installed_sha256"):
+        with open(key_filename, "rb") as fp:
+            # noinspection PyTypeChecker
+            installed_sha256 = file_digest(fp, hashlib.sha256).hexdigest()
+        if installed_sha256 == meta["installed_sha256"]:
+            logging.info(f"Keys from {key_url} unchanged and already installed in {key_filename}. Skipping.")
             return
 
-    gpg_dearmor(key_content, key_filename)
+    upstream_fingerprints = gpg_show_keys(content=key_content).fingerprints()
+    if not upstream_fingerprints:
+        raise Exception(f"No keys found in {key_url}")
+    if not (os.path.isfile(key_filename) and
+            not upstream_fingerprints - gpg_show_keys(filename=key_filename).fingerprints()):
+        gpg_dearmor(key_content, key_filename)
+    else:
+        logging.info(f"Keys from {key_url} already present in {key_filename}. Skipping.")
+    with open(key_filename, "rb") as fp:
+        # noinspection PyTypeChecker
+        meta["installed_sha256"] = file_digest(fp, hashlib.sha256).hexdigest()
+    meta["fingerprints"] = sorted(upstream_fingerprints)
+    _write_cached_key(cache_dir, name, key_content, meta)
 
 
 source_entry_regex = re.compile(
@@ -39,6 +109,15 @@ source_entry_regex = re.compile(
     r"(\s*#.*)?$")
 
 sources_list_filename_regex = re.compile(r"^[A-Za-z0-9_.-]+\.list$")
+deb822_sources_filename_regex = re.compile(r"^[A-Za-z0-9_.-]+\.sources$")
+
+# deb822 fields that map to one-line style options with a different name. Other fields are lower-cased.
+deb822_option_names = {
+    "Architectures": "arch",
+    "Languages": "lang",
+    "Targets": "target",
+}
+deb822_entry_fields = {"Types", "URIs", "Suites", "Components", "Enabled"}
 
 
 def parse_source_entry(line):
@@ -74,6 +153,40 @@ def read_sources_file(filename):
         return list(filter(None, map(parse_source_entry, fp)))
 
 
+def read_deb822_sources_file(filename):
+    with open(filename, "r") as fp:
+        content = "".join(line for line in fp if not line.startswith("#"))
+    stanzas = [parse_control(stanza) for stanza in re.split(r"\n\s*\n", content) if stanza.strip()]
+    result = []
+    for stanza in stanzas:
+        if stanza.get("Enabled", "yes").lower() == "no":
+            continue
+        options = {
+            deb822_option_names.get(k, k.lower()): v.split() if len(v.split()) > 1 else v
+            for k, v in stanza.items()
+            if k not in deb822_entry_fields and "\n" not in v
+        }
+        for source_type in stanza.get("Types", "").split():
+            for uri in stanza.get("URIs", "").split():
+                for suite in stanza.get("Suites", "").split():
+                    result.append({
+                        "type": source_type,
+                        "options": options or None,
+                        "uri": uri,
+                        "suite": suite,
+                        "components": stanza.get("Components", "").split(),
+                    })
+    return result
+
+
+def _as_list(v):
+    return list(v) if isinstance(v, (list, tuple)) else [v]
+
+
+def _normalize_uri(uri):
+    return uri.rstrip("/")
+
+
 def source_match(new_source, existing_source):
     for k, v in new_source.items():
         if k not in {'uri', 'type', 'options', 'components', 'suite'}:
@@ -81,52 +194,182 @@ def source_match(new_source, existing_source):
         if existing_source.get(k) is None:
             return False
         ev = existing_source[k]
-        if k == "components":
+        if k == "uri":
+            if _normalize_uri(v) != _normalize_uri(ev):
+                return False
+        elif k in {"type", "suite"}:
+            if v != ev:
+                return False
+        elif k == "components":
             if set(v) - set(ev):
                 return False
-        if k == "options":
+        elif k == "options":
             for ok, ov in v.items():
                 if ok not in ev:
                     return False
-                if set(ov) - set(ev[ok]):
+                if set(_as_list(ov)) - set(_as_list(ev[ok])):
                     return False
     return True
 
 
-def install_apt_source(name, source):
-    for f in [
-                 os.path.join(apt_sources_list_dir, f)
-                 for f in
-                 os.listdir(apt_sources_list_dir)
-                 if sources_list_filename_regex.match(f)
-             ] + [apt_sources_list_file]:
-        if os.path.isfile(f):
-            for s in read_sources_file(f):
-                if source_match(source, s):
-                    logging.info(f"Source '{format_source_entry(s)}' found in file {f}. Skipping.")
-                    return False
+def get_sources_files():
+    if not os.path.isdir(apt_sources_list_dir):
+        return [apt_sources_list_file]
+    return [
+               os.path.join(apt_sources_list_dir, f)
+               for f in
+               sorted(os.listdir(apt_sources_list_dir))
+               if sources_list_filename_regex.match(f) or deb822_sources_filename_regex.match(f)
+           ] + [apt_sources_list_file]
+
 
-    os.makedirs(apt_sources_list_dir, exist_ok=True)
+class SourcesIndex(object):
+    """All configured apt sources, parsed once and indexed by URI and suite, with batched writes of new sources."""
 
-    with open(os.path.join(apt_sources_list_dir, f"{name}.list"), "a") as fp:
-        fp.write(f"\n{format_source_entry(source)}\n")
+    def __init__(self, files=None):
+        self.entries = []
+        self._index = {}
+        self._pending = {}
+        for f in get_sources_files() if files is None else files:
+            if os.path.isfile(f):
+                if deb822_sources_filename_regex.match(os.path.basename(f)):
+                    sources = read_deb822_sources_file(f)
+                else:
+                    sources = read_sources_file(f)
+                for source in sources:
+                    self._add_entry(f, source)
 
+    def _add_entry(self, filename, source):
+        self.entries.append((filename, source))
+        self._index.setdefault((_normalize_uri(source["uri"]), source["suite"]), []).append((filename, source))
+
+    def find(self, source):
+        for filename, existing_source in self._index.get((_normalize_uri(source["uri"]), source["suite"]), []):
+            if source_match(source, existing_source):
+                return filename, existing_source
+        return None
+
+    def add(self, name, source):
+        filename = os.path.join(apt_sources_list_dir, f"{name}.list")
+        self._add_entry(filename, source)
+        self._pending.setdefault(filename, []).append(format_source_entry(source))
+
+    def flush(self):
+        if not self._pending:
+            return False
+        os.makedirs(apt_sources_list_dir, exist_ok=True)
+        for filename, lines in self._pending.items():
+            with open(filename, "a") as fp:
+                fp.write("".join(f"\n{line}\n" for line in lines))
+        self._pending.clear()
+        return True
+
+
+# Ubuntu only publishes amd64 and i386 on its main archive, other architectures live on ports.ubuntu.com
+ubuntu_primary_architectures = {"amd64", "i386"}
+ubuntu_ports_uri_regex = re.compile(r"^https?://([a-z]{2}\.)?(archive|security)\.ubuntu\.com/ubuntu/?$")
+ubuntu_ports_uri = "http://ports.ubuntu.com/ubuntu-ports"
+
+
+def retarget_source(source, suite, architecture, host_codename):
+    """A copy of a host source pointed at another suite and architecture."""
+    s = dict(source)
+    if s["suite"] == host_codename or s["suite"].startswith(f"{host_codename}-"):
+        s["suite"] = suite + s["suite"][len(host_codename):]
+    if architecture not in ubuntu_primary_architectures and ubuntu_ports_uri_regex.match(s["uri"]):
+        s["uri"] = ubuntu_ports_uri
+    s["options"] = {**(s.get("options") or {}), "arch": architecture}
+    return s
+
+
+def get_target_sources(suite, architecture, index=None):
+    host_codename = get_codename()
+    return [
+        format_source_entry(retarget_source(s, suite, architecture, host_codename))
+        for _, s in (index or SourcesIndex()).entries
+        if s["type"] == "deb"
+    ]
+
+
+def install_apt_source(name, source, index=None):
+    flush = index is None
+    index = index or SourcesIndex()
+    existing = index.find(source)
+    if existing is not None:
+        filename, s = existing
+        logging.info(f"Source '{format_source_entry(s)}' found in file {filename}. Skipping.")
+        return False
+
+    index.add(name, source)
+    if flush:
+        index.flush()
     return True
 
 
-def install_apt_sources(sources):
+def install_apt_sources(sources, cache_dir=None):
     repositories = load_yaml(sources)
     if repositories:
-        changed = False
+        index = SourcesIndex()
+        key_urls = {n: r['key_url'] for n, r in repositories.items() if r.get('key_url')}
+        session = create_session(max(1, len(key_urls)))
+        with ThreadPoolExecutor(max_workers=max(1, len(key_urls))) as executor:
+            fetched_keys = {
+                n: executor.submit(fetch_apt_key, key_url, n, session, cache_dir)
+                for n, key_url in key_urls.items()
+            }
         for n, r in repositories.items():
             r.setdefault("type", "deb")
             r.setdefault("options", {"arch": get_dpkg_architecture()["DEB_HOST_ARCH"]})
             r.setdefault("suite", get_codename())
             r.setdefault("components", ["main"])
 
-            if r.get('key_url'):
-                install_apt_key(r['key_url'], n)
+            if n in fetched_keys:
+                install_apt_key(r['key_url'], n, session, cache_dir, fetched_keys[n].result())
 
-            changed = install_apt_source(n, r) or changed
-        if changed:
+            install_apt_source(n, r, index)
+        if index.flush():
             update_apt_cache()
+
+
+def fetch_repository_keyrings(repositories, cache_dir):
+    """Fetch the keys of the repositories that have a key_url into binary keyrings in the cache directory, without
+    installing them on the host. Returns the keyring filename of each repository."""
+    key_urls = {n: r['key_url'] for n, r in (repositories or {}).items() if r.get('key_url')}
+    if not key_urls:
+        return {}
+    os.makedirs(os.path.join(cache_dir, "keys"), exist_ok=True)
+    session = create_session(len(key_urls))
+    with ThreadPoolExecutor(max_workers=len(key_urls)) as executor:
+        fetched_keys = {
+            n: executor.submit(fetch_apt_key, key_url, n, session, cache_dir)
+            for n, key_url in key_urls.items()
+        }
+    result = {}
+    for n, future in fetched_keys.items():
+        key_content, meta, unchanged = future.result()
+        keyring = os.path.join(cache_dir, "keys", f"{n}.gpg")
+        if not (unchanged and os.path.isfile(keyring)):
+            gpg_dearmor(key_content, keyring)
+            _write_cached_key(cache_dir, n, key_content, meta)
+        result[n] = keyring
+    return result
+
+
+def get_repository_sources(repositories, suite, architecture, keyrings=None):
+    """The sources of the configured repositories for a target, defaulted like install_apt_sources does for the host,
+    with the keyrings from fetch_repository_keyrings as their signed-by option."""
+    host_codename = get_codename()
+    result = []
+    for n, r in (repositories or {}).items():
+        source = {
+            "type": r.get("type", "deb"),
+            "options": dict(r.get("options") or {}),
+            "uri": r["uri"],
+            "suite": r.get("suite", suite),
+            "components": r.get("components", ["main"]),
+        }
+        if keyrings and n in keyrings:
+            source["options"].setdefault("signed-by", keyrings[n])
+        if source["type"] == "deb":
+            result.append(retarget_source(source, suite, architecture, host_codename))
+    return result
@@ -0,0 +1,77 @@
+import functools
+import re
+
+version_regex = re.compile(r"^(?:(?P<epoch>\d+):)?(?P<upstream>.+?)(?:-(?P<revision>[^-]*))?$")
+
+
+def _order(c):
+    if not c or c.isdigit():
+        return 0
+    if c == "~":
+        return -1
+    if c.isalpha():
+        return ord(c)
+    return ord(c) + 256
+
+
+def _compare_fragment(a, b):
+    """dpkg's verrevcmp: non-digit runs compare character by character, with ~ sorting before everything, even the
+    end of the string, and letters before other characters. Digit runs compare numerically."""
+    i = j = 0
+    while i < len(a) or j < len(b):
+        while (i < len(a) and not a[i].isdigit()) or (j < len(b) and not b[j].isdigit()):
+            ac = _order(a[i] if i < len(a) else "")
+            bc = _order(b[j] if j < len(b) else "")
+            if ac != bc:
+                return -1 if ac < bc else 1
+            i += 1
+            j += 1
+        start_i = i
+        while i < len(a) and a[i].isdigit():
+            i += 1
+        start_j = j
+        while j < len(b) and b[j].isdigit():
+            j += 1
+        an = int(a[start_i:i] or "0")
+        bn = int(b[start_j:j] or "0")
+        if an != bn:
+            return -1 if an < bn else 1
+    return 0
+
+
+def parse_version(version):
+    match = version_regex.match(version.strip())
+    if not match:
+        raise ValueError(f"Invalid version: {version!r}")
+    return int(match.group("epoch") or 0), match.group("upstream"), match.group("revision") or ""
+
+
+@functools.lru_cache(maxsize=65536)
+def version_compare(a, b):
+    """Compare two Debian versions like dpkg --compare-versions, returning -1, 0 or 1."""
+    if a == b:
+        return 0
+    a_epoch, a_upstream, a_revision = parse_version(a)
+    b_epoch, b_upstream, b_revision = parse_version(b)
+    if a_epoch != b_epoch:
+        return -1 if a_epoch < b_epoch else 1
+    return _compare_fragment(a_upstream, b_upstream) or _compare_fragment(a_revision, b_revision)
+
+
+version_relations = {
+    "<<": lambda c: c < 0,
+    "<=": lambda c: c <= 0,
+    "=": lambda c: c == 0,
+    ">=": lambda c: c >= 0,
+    ">>": lambda c: c > 0,
+    "!=": lambda c: c != 0,
+    # Obsolete forms, which dpkg still accepts
+    "<": lambda c: c <= 0,
+    ">": lambda c: c >= 0,
+}
+
+
+def version_satisfies(version, relation, required_version):
+    if not relation:
+        return True
+    return version_relations[relation](version_compare(version, required_version))
@@ -1,10 +1,19 @@
+import collections
+import functools
+import hashlib
+import mmap
 import os
+import sqlite3
 import subprocess
 import sys
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from typing import Dict
 
 import yaml
 
+from lpu.metrics import metrics, check_output
+
 
 def file_digest(fileobj, digest, /, *, _bufsize=2 ** 18):
     """Hash the contents of a file-like object. Returns a digest object.
@@ -49,6 +58,87 @@ def file_digest(fileobj, digest, /, *, _bufsize=2 ** 18):
     return digestobj
 
 
+def file_multi_digest(fileobj, digests, /, *, _bufsize=2 ** 18):
+    """Hash the contents of a file-like object with several digests at once.
+
+    *digests* is a mapping of names to anything accepted as *digest* by
+    file_digest(). The file is read only once. Returns a tuple of a dict of
+    digest objects keyed by the same names, and the number of bytes read.
+    """
+    digestobjs = {name: digest() for name, digest in digests.items()}
+
+    if hasattr(fileobj, "getbuffer"):
+        buffer = fileobj.getbuffer()
+        for digestobj in digestobjs.values():
+            digestobj.update(buffer)
+        return digestobjs, len(buffer)
+
+    if not (
+            hasattr(fileobj, "readinto")
+            and hasattr(fileobj, "readable")
+            and fileobj.readable()
+    ):
+        raise ValueError(
+            f"'{fileobj!r}' is not a file-like object in binary reading mode."
+        )
+
+    buf = bytearray(_bufsize)
+    view = memoryview(buf)
+    total = 0
+    while True:
+        size = fileobj.readinto(buf)
+        if size == 0:
+            break  # EOF
+        total += size
+        for digestobj in digestobjs.values():
+            digestobj.update(view[:size])
+
+    return digestobjs, total
+
+
+# Files at least this large are hashed through a memory map instead of read() calls
+mmap_threshold = 2 ** 22
+# Size of the slices of large files each digest is updated with, to keep the data in cache between digests
+mmap_chunk_size = 2 ** 23
+
+
+def path_multi_digest(path, digests):
+    """Hash a file with several digests at once, mapping it into memory if it is large.
+
+    Returns the same as file_multi_digest(). hashlib releases the GIL while
+    hashing large buffers, so this scales across threads.
+    """
+    with open(path, "rb") as fp:
+        size = os.fstat(fp.fileno()).st_size
+        metrics.add("hashed_files")
+        metrics.add("hashed_bytes", size)
+        if size < mmap_threshold:
+            # noinspection PyTypeChecker
+            return file_multi_digest(fp, digests, _bufsize=2 ** 20)
+        digestobjs = {name: digest() for name, digest in digests.items()}
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mm, "madvise"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(mm)
+            try:
+                for offset in range(0, len(mm), mmap_chunk_size):
+                    chunk = view[offset:offset + mmap_chunk_size]
+                    for digestobj in digestobjs.values():
+                        digestobj.update(chunk)
+                    chunk.release()
+            finally:
+                view.release()
+            return digestobjs, len(mm)
+
+
+def _hash_path(path, algorithms):
+    """Hash a file with hashlib algorithms given by name, in a form that can be sent to a worker process."""
+    st = os.stat(path)
+    digestobjs, size = path_multi_digest(path, {name: functools.partial(hashlib.new, algorithm)
+                                                for name, algorithm in algorithms.items()})
+    return {name: digestobj.hexdigest() for name, digestobj in digestobjs.items()}, size, st, os.stat(path)
+
+
 def single(lst, default=None):
     it = iter(lst)
     result = next(it, default)
@@ -59,11 +149,212 @@ def single(lst, default=None):
     raise ValueError()
 
 
-def hash_files(files, digest):
+def open_sqlite(filename):
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    connection = sqlite3.connect(filename, isolation_level=None, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+
+class HashCache(object):
+    """Persistent cache of file digests, keyed by path, size, mtime and inode."""
+
+    def __init__(self, filename):
+        self._lock = threading.Lock()
+        self._connection = open_sqlite(filename)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS hashes ("
+            "path TEXT NOT NULL, algorithm TEXT NOT NULL, "
+            "size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, inode INTEGER NOT NULL, "
+            "hexdigest TEXT NOT NULL, "
+            "PRIMARY KEY (path, algorithm))")
+
+    @staticmethod
+    def _key(path, st):
+        return os.path.abspath(path), st.st_size, st.st_mtime_ns, st.st_ino
+
+    def get(self, path, algorithms, st=None):
+        st = st or os.stat(path)
+        path, size, mtime_ns, inode = self._key(path, st)
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT algorithm, hexdigest FROM hashes "
+                "WHERE path = ? AND size = ? AND mtime_ns = ? AND inode = ?",
+                (path, size, mtime_ns, inode)).fetchall()
+        return {algorithm: hexdigest for algorithm, hexdigest in rows if algorithm in algorithms}
+
+    def put(self, path, hexdigests, st=None):
+        st = st or os.stat(path)
+        path, size, mtime_ns, inode = self._key(path, st)
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO hashes (path, algorithm, size, mtime_ns, inode, hexdigest) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(path, algorithm, size, mtime_ns, inode, hexdigest) for algorithm, hexdigest in hexdigests.items()])
+
+    def hash_file(self, path, digests):
+        algorithms = {name: digest().name for name, digest in digests.items()}
+        st = os.stat(path)
+        cached = self.get(path, set(algorithms.values()), st)
+        missing = {name: digest for name, digest in digests.items() if algorithms[name] not in cached}
+        if missing:
+            digestobjs, _ = path_multi_digest(path, missing)
+            computed = {algorithms[name]: digestobj.hexdigest() for name, digestobj in digestobjs.items()}
+            # Only remember digests if the file did not change while it was being read
+            if self._key(path, os.stat(path)) == self._key(path, st):
+                self.put(path, computed, st)
+            cached.update(computed)
+        else:
+            metrics.add("hash_cache_hits")
+        return {name: cached[algorithm] for name, algorithm in algorithms.items()}, st.st_size
+
+    def close(self):
+        self._connection.close()
+
+
+class ContentCache(object):
+    """Persistent cache of values derived from file contents, keyed by a content digest."""
+
+    def __init__(self, filename, namespace):
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._connection = open_sqlite(filename)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS content ("
+            "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+            "PRIMARY KEY (namespace, key))")
+
+    def get(self, key):
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM content WHERE namespace = ? AND key = ?",
+                                           (self.namespace, key)).fetchone()
+        return row[0] if row is not None else None
+
+    def put(self, key, value):
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO content (namespace, key, value) VALUES (?, ?, ?)",
+                                     (self.namespace, key, value))
+
+    def close(self):
+        self._connection.close()
+
+
+def hash_file(f, digests, hash_cache=None):
+    if hash_cache is not None:
+        return hash_cache.hash_file(f, digests)
+    digestobjs, size = path_multi_digest(f, digests)
+    return {name: digestobj.hexdigest() for name, digestobj in digestobjs.items()}, size
+
+
+class HashEngine(object):
+    """Hashes many files in parallel, yielding results in the order the files were given.
+
+    Threads are used by default, as hashlib releases the GIL while hashing. With processes=True, digests are
+    computed in worker processes instead, and the hash cache is consulted and updated from the calling thread.
+    """
+
+    def __init__(self, jobs=None, processes=False):
+        self.jobs = max(1, jobs or os.cpu_count() or 1)
+        self.processes = processes
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = (ProcessPoolExecutor if self.processes else ThreadPoolExecutor)(
+                    max_workers=self.jobs)
+            return self._executor
+
+    def _submit(self, f, digests, hash_cache):
+        if not self.processes:
+            return self._get_executor().submit(hash_file, f, digests, hash_cache)
+        algorithms = {name: digest().name for name, digest in digests.items()}
+        if hash_cache is not None:
+            cached = hash_cache.get(f, set(algorithms.values()))
+            if set(algorithms.values()) <= set(cached):
+                future = Future()
+                future.set_result(({name: cached[algorithm] for name, algorithm in algorithms.items()},
+                                   os.path.getsize(f)))
+                return future
+        future = self._get_executor().submit(_hash_path, f, algorithms)
+        result = Future()
+
+        def _done(_):
+            try:
+                hexdigests, size, st_before, st_after = future.result()
+            except BaseException as e:
+                result.set_exception(e)
+                return
+            if hash_cache is not None and HashCache._key(f, st_before) == HashCache._key(f, st_after):
+                hash_cache.put(f, {algorithms[name]: hexdigest for name, hexdigest in hexdigests.items()}, st_before)
+            metrics.add("hashed_files")
+            metrics.add("hashed_bytes", size)
+            result.set_result((hexdigests, size))
+
+        future.add_done_callback(_done)
+        return result
+
+    def hash_files_multi(self, files, digests, hash_cache=None):
+        if self.jobs == 1 and not self.processes:
+            for f in files:
+                hexdigests, size = hash_file(f, digests, hash_cache)
+                yield hexdigests, size, f
+            return
+        # A bounded window of files in flight keeps memory constant for any number of files
+        pending = collections.deque()
+        for f in files:
+            pending.append((f, self._submit(f, digests, hash_cache)))
+            if len(pending) >= self.jobs * 4:
+                f, future = pending.popleft()
+                yield (*future.result(), f)
+        while pending:
+            f, future = pending.popleft()
+            yield (*future.result(), f)
+
+    def hash_files(self, files, digest):
+        for hexdigests, size, f in self.hash_files_multi(files, {"": digest}):
+            yield hexdigests[""], size, f
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def hash_files(files, digest, hash_cache=None, engine=None):
+    for hexdigests, size, f in hash_files_multi(files, {"": digest}, hash_cache, engine):
+        yield hexdigests[""], size, f
+
+
+def hash_files_multi(files, digests, hash_cache=None, engine=None):
+    if engine is not None:
+        yield from engine.hash_files_multi(files, digests, hash_cache)
+        return
     for f in files:
-        with open(f, "rb") as fp:
-            # noinspection PyTypeChecker
-            yield file_digest(fp, digest).hexdigest(), os.path.getsize(f), f
+        hexdigests, size = hash_file(f, digests, hash_cache)
+        yield hexdigests, size, f
+
+
+def get_hash_cache(config):
+    if config["no_hash_cache"]:
+        return None
+    return HashCache(os.path.join(config["cache_dir"], "hashes.sqlite"))
+
+
+def get_hash_engine(config):
+    return HashEngine(config["hash_jobs"], config["hash_processes"])
+
+
+def get_content_cache(config, namespace):
+    return ContentCache(os.path.join(config["cache_dir"], "content.sqlite"), namespace)
 
 
 def walk_files(base_dir):
@@ -136,7 +427,7 @@ def get_dpkg_architecture() -> Dict[str, str]:
         (
             line.split("=", maxsplit=1)
             for line in
-            subprocess.check_output(["dpkg-architecture"], stderr=subprocess.DEVNULL).decode().splitlines()
+            check_output(["dpkg-architecture"], stderr=subprocess.DEVNULL).decode().splitlines()
         )
     }
 
@@ -148,7 +439,7 @@ def get_lsb_release() -> Dict[str, str]:
         (
             line.split(":", maxsplit=1)
             for line in
-            subprocess.check_output(["lsb_release", "-a"], stderr=subprocess.DEVNULL).decode().splitlines()
+            check_output(["lsb_release", "-a"], stderr=subprocess.DEVNULL).decode().splitlines()
         )
     }
 
@@ -0,0 +1,58 @@
+import gzip
+import lzma
+import shutil
+
+from lpu.metrics import run_subprocess
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def zstd_compress(data, level):
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=level, threads=-1).compress(data)
+    return run_subprocess(["zstd", f"-{level}", "-T0", "-c"], input=data, capture_output=True, check=True).stdout
+
+
+def zstd_decompress(data):
+    if zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return run_subprocess(["zstd", "-dc"], input=data, capture_output=True, check=True).stdout
+
+
+compressors = {
+    "gz": lambda data, level: gzip.compress(data, level, mtime=0),
+    "xz": lambda data, level: lzma.compress(data, preset=level),
+    "zst": zstd_compress,
+}
+
+decompressors = {
+    "gz": gzip.decompress,
+    "xz": lzma.decompress,
+    "zst": zstd_decompress,
+}
+
+
+def compress(data, extension, level):
+    return compressors[extension](data, level)
+
+
+def decompress(data, extension):
+    return decompressors[extension](data)
+
+
+def decompress_file(src, dst, extension):
+    """Decompress the file object src into dst, streaming where the format allows it."""
+    if extension == "gz":
+        reader = gzip.GzipFile(fileobj=src, mode="rb")
+    elif extension == "xz":
+        reader = lzma.LZMAFile(src, mode="rb")
+    elif extension == "zst" and zstandard is not None:
+        reader = zstandard.ZstdDecompressor().stream_reader(src)
+    else:
+        dst.write(decompress(src.read(), extension))
+        return
+    with reader:
+        shutil.copyfileobj(reader, dst, 2 ** 20)
@@ -0,0 +1,167 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
+from urllib.request import url2pathname
+
+import requests
+import requests.adapters
+
+from lpu.metrics import metrics
+
+content_range_regex = re.compile(r"^bytes\s+(?:(?P<start>\d+)-(?P<end>\d+)|\*)/(?P<total>\d+|\*)$")
+
+
+def create_session(pool_size=10):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class Downloader(object):
+    def __init__(self, jobs=4, jobs_per_host=2, retries=3, backoff=1.0, timeout=60, session=None, hash_cache=None):
+        self.jobs = max(1, jobs)
+        self.jobs_per_host = max(1, jobs_per_host)
+        self.retries = max(0, retries)
+        self.backoff = backoff
+        self.timeout = timeout
+        self.hash_cache = hash_cache
+        self.session = session or create_session(self.jobs)
+        self._host_semaphores = {}
+        self._lock = threading.Lock()
+
+    def _host_semaphore(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = threading.BoundedSemaphore(self.jobs_per_host)
+            return self._host_semaphores[host]
+
+    @staticmethod
+    def _is_retryable(e):
+        if isinstance(e, requests.HTTPError) and e.response is not None:
+            return e.response.status_code >= 500 or e.response.status_code == 429
+        return isinstance(e, (requests.RequestException, ChecksumMismatch))
+
+    def _iter_content(self, url, offset=0):
+        """Yields (start, total) describing the returned range, followed by the content chunks.
+
+        start is None when the server rejected the range, in which case no chunks follow.
+        """
+        parts = urlsplit(url)
+        if parts.scheme == "file":
+            with open(url2pathname(parts.path), "rb") as fp:
+                total = os.fstat(fp.fileno()).st_size
+                if offset > total:
+                    yield None, total
+                    return
+                fp.seek(offset)
+                yield offset, total
+                yield from iter(lambda: fp.read(2 ** 18), b"")
+        else:
+            headers = {"Range": f"bytes={offset}-"} if offset else {}
+            with self.session.get(url, stream=True, timeout=self.timeout, headers=headers) as r:
+                if r.status_code == 416:
+                    match = content_range_regex.match(r.headers.get("Content-Range", ""))
+                    yield None, int(match.group("total")) if match and match.group("total") != "*" else None
+                    return
+                r.raise_for_status()
+                if r.status_code == 206:
+                    match = content_range_regex.match(r.headers.get("Content-Range", ""))
+                    if not match or match.group("start") is None:
+                        raise requests.RequestException(f"Invalid Content-Range in response for {url}")
+                    total = match.group("total")
+                    yield int(match.group("start")), int(total) if total != "*" else None
+                else:
+                    length = r.headers.get("Content-Length")
+                    yield 0, int(length) if length and "Content-Encoding" not in r.headers else None
+                yield from r.iter_content(chunk_size=2 ** 18)
+
+    def _fetch(self, url, filepath, sha256):
+        partial_filepath = f"{filepath}.partial"
+        offset = os.path.getsize(partial_filepath) if os.path.isfile(partial_filepath) else 0
+        digestobj = hashlib.sha256()
+        if offset:
+            with open(partial_filepath, "rb") as fp:
+                # Hash the part downloaded by a previous run, so the result can be verified without a second pass
+                for chunk in iter(lambda: fp.read(2 ** 18), b""):
+                    digestobj.update(chunk)
+        content = self._iter_content(url, offset)
+        try:
+            start, total = next(content)
+            if start is None:
+                if offset and offset == total and (sha256 is None or digestobj.hexdigest() == sha256):
+                    logging.debug(f"{partial_filepath} is already complete")
+                else:
+                    # The partial file does not match the remote file, start over on the next attempt
+                    os.remove(partial_filepath)
+                    raise RangeNotSatisfiable(f"Could not resume {url} at offset {offset}")
+            else:
+                if start != offset:
+                    if start != 0:
+                        raise requests.RequestException(f"Expected {url} to resume at {offset}, got {start}")
+                    if offset:
+                        logging.debug(f"Server does not support resuming {url}, restarting from scratch")
+                    digestobj = hashlib.sha256()
+                elif offset:
+                    logging.info(f"Resuming {url} at {offset} of {total or 'unknown'} bytes")
+                downloaded = 0
+                with open(partial_filepath, "ab" if start else "wb") as fp:
+                    for chunk in content:
+                        fp.write(chunk)
+                        digestobj.update(chunk)
+                        downloaded += len(chunk)
+                metrics.add("downloaded_bytes", downloaded)
+        finally:
+            content.close()
+        if sha256 is not None and digestobj.hexdigest() != sha256:
+            os.remove(partial_filepath)
+            raise ChecksumMismatch(f"SHA256 mismatch for {url}: expected {sha256}, got {digestobj.hexdigest()}")
+        os.replace(partial_filepath, filepath)
+        metrics.add("downloaded_files")
+        if self.hash_cache is not None:
+            self.hash_cache.put(filepath, {"sha256": digestobj.hexdigest()})
+
+    def download(self, url, filepath, sha256=None):
+        attempt = 0
+        while True:
+            try:
+                with self._host_semaphore(url):
+                    logging.info(f"Downloading {url} ...")
+                    self._fetch(url, filepath, sha256)
+                return filepath
+            except Exception as e:
+                if attempt >= self.retries or not self._is_retryable(e):
+                    raise
+                delay = self.backoff * 2 ** attempt
+                attempt += 1
+                logging.warning(f"Downloading {url} failed ({e}), retrying in {delay:.1f}s "
+                                f"({attempt}/{self.retries}) ...")
+                time.sleep(delay)
+
+    def download_all(self, downloads):
+        errors = []
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = {executor.submit(self.download, *d): d for d in downloads}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    logging.error(f"Downloading {futures[future][0]} failed: {e}")
+                    errors.append(futures[future][0])
+        if errors:
+            raise Exception(f"Failed to download {len(errors)} file(s): {', '.join(sorted(errors))}")
+
+
+class ChecksumMismatch(Exception):
+    pass
+
+
+class RangeNotSatisfiable(requests.RequestException):
+    pass
@@ -1,114 +1,145 @@
+import io
+import os
 import re
 import subprocess
+import threading
+import time
 
-gpg_field_names = [
-    "record_type", "validity", "key_length", "key_algorithm", "key_id", "creation_date",
-    "expiration_date", "certificate", "owner_trust", "user_id", "signature_class", "key_capabilities",
-    "issuer_certificate_fingerprint", "flag", "serial_number", "hash_algorithm", "curve_name",
-    "compliance_flags", "last_update", "origin", "comment"
-]
+from lpu.metrics import metrics, check_output, run_subprocess
+
+
+class GpgKey(object):
+    """A key record from gpg --with-colons output, with its fingerprint, keygrip, and for primary keys their user ids
+    and subkeys."""
+    __slots__ = ("record_type", "validity", "key_length", "key_algorithm", "key_id", "creation_date",
+                 "expiration_date", "key_capabilities", "fingerprint", "keygrip", "uids", "subkeys")
+
+    def __init__(self, fields):
+        (self.record_type, self.validity, self.key_length, self.key_algorithm, self.key_id, self.creation_date,
+         self.expiration_date) = fields[:7]
+        self.key_capabilities = fields[11] if len(fields) > 11 else ""
+        self.fingerprint = None
+        self.keygrip = None
+        self.uids = []
+        self.subkeys = []
+
+    def __repr__(self):
+        return f"GpgKey({self.record_type} {self.key_id} {self.fingerprint})"
+
+
+class GpgKeyRing(object):
+    """Primary keys parsed from gpg --with-colons output, indexed by the key ids and fingerprints of their primary
+    keys and subkeys."""
+
+    def __init__(self, keys):
+        self.keys = list(keys)
+        self._index = {}
+        for key in self.keys:
+            for k in [key, *key.subkeys]:
+                self._index.setdefault(k.key_id, key)
+                if k.fingerprint:
+                    self._index.setdefault(k.fingerprint, key)
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key_id_or_fingerprint):
+        return key_id_or_fingerprint.upper() in self._index
+
+    def find(self, key_id_or_fingerprint):
+        return self._index.get(key_id_or_fingerprint.upper())
+
+    def fingerprints(self):
+        return {key.fingerprint for key in self.keys if key.fingerprint}
+
+
+def gpg_iter_keys(lines):
+    key = None
+    current = None
+    for line in lines:
+        fields = line.rstrip("\r\n").split(":")
+        record_type = fields[0]
+        if record_type in {"pub", "sec"}:
+            if key is not None:
+                yield key
+            key = current = GpgKey(fields)
+        elif key is None:
+            continue
+        elif record_type in {"sub", "ssb"}:
+            current = GpgKey(fields)
+            key.subkeys.append(current)
+        elif record_type == "fpr" and current.fingerprint is None:
+            current.fingerprint = fields[9]
+        elif record_type == "grp" and current.keygrip is None:
+            current.keygrip = fields[9]
+        elif record_type == "uid":
+            key.uids.append(fields[9])
+    if key is not None:
+        yield key
 
 
 def gpg_parse_key_list(lines):
-    return [dict(zip(gpg_field_names, line.split(":"))) for line in lines]
+    return GpgKeyRing(gpg_iter_keys(lines))
+
 
+def gpg_read_key_list(args, content=None):
+    start = time.perf_counter()
+    p = subprocess.Popen(args, stdin=subprocess.DEVNULL if content is None else subprocess.PIPE,
+                         stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    writer = None
+    if content is not None:
+        def _write():
+            try:
+                p.stdin.write(content)
+            finally:
+                p.stdin.close()
+
+        writer = threading.Thread(target=_write, daemon=True)
+        writer.start()
+    try:
+        return gpg_parse_key_list(io.TextIOWrapper(p.stdout, encoding="utf-8", errors="replace"))
+    finally:
+        p.stdout.close()
+        p.wait()
+        if writer is not None:
+            writer.join()
+        metrics.record_subprocess(args, time.perf_counter() - start)
 
+
+# The gpg_* functions run a single command in the default keyring, through a GpgSession
 def gpg_show_keys(filename=None, content=None):
-    assert not (filename is not None and content is not None)
-    args = [
-        "gpg",
-        "--show-keys",
-        "--with-colons",
-    ]
-    if filename is not None:
-        args.append(filename)
-    p = subprocess.run(args, capture_output=True, input=content)
-    return gpg_parse_key_list(p.stdout.decode().splitlines())
+    return GpgSession().show_keys(filename, content)
 
 
 def gpg_list_keys(key_id=None, secret=False):
-    args = [
-        "gpg",
-        "--list-secret-keys" if secret else "--list-keys",
-        "--with-colons"
-    ]
-    if key_id is not None:
-        args.append(key_id)
-    p = None
-    try:
-        p = subprocess.run(args, capture_output=True)
-    except subprocess.CalledProcessError as e:
-        if e.returncode:
-            if e.returncode == 2 and \
-                    key_id is not None and \
-                    e.stderr.splitlines()[0] == "gpg: error reading key: No secret key":
-                return []
-        else:
-            raise
-    assert p is not None
-    return gpg_parse_key_list(p.stdout.decode().splitlines())
+    return GpgSession().list_keys(secret, key_id)
 
 
 def get_secret_key_ids(key_list):
-    return [k["key_id"] for k in key_list if k["record_type"] == "sec"]
+    return [k.key_id for k in key_list if k.record_type == "sec"]
 
 
 def gpg_gen_key(**key_meta):
-    assert 'Passphrase' in key_meta
-    gpg_batch = "\n".join(f"{k}: {v}" for k, v in key_meta.items())
-    gpg_batch += "\n"
-    gpg_batch += "\n".join(["%no-ask-passphrase", "%no-protection", "%commit"])
-    gpg_batch += "\n"
-    gen_key_output = subprocess.check_output([
-        "gpg",
-        "--gen-key",
-        "--batch"],
-        input=gpg_batch.encode(),
-        stderr=subprocess.STDOUT).decode()
-    return re.search("gpg: key ([0-9A-F]+) marked as ultimately trusted", gen_key_output).group(1)
+    return GpgSession().gen_key(**key_meta)
 
 
 def gpg_export_secret_key(key_id, output_file):
-    subprocess.check_output([
-        "gpg",
-        "--export-secret-keys",
-        "--armor",
-        "-o", output_file,
-        key_id
-    ], stderr=subprocess.DEVNULL)
+    GpgSession().export_secret_key(key_id, output_file)
 
 
 def gpg_import(key_file):
-    return subprocess.check_output([
-        "gpg",
-        "--import",
-        key_file
-    ], stderr=subprocess.DEVNULL)
+    return GpgSession().import_key(key_file)
 
 
 def gpg_export_key(key_id, output_file):
-    subprocess.check_output([
-        "gpg",
-        "--export",
-        "--armor",
-        "--yes",
-        "--output", output_file,
-        key_id
-    ], stderr=subprocess.DEVNULL)
+    GpgSession().export_key(key_id, output_file)
 
 
 def gpg_sign(key_id, key_passphrase, input_file, output_file, detached=False):
-    subprocess.check_output([
-        "gpg",
-        "--sign",
-        "--detach-sign" if detached else "--clearsign",
-        "--armor",
-        "--yes",
-        "--default-key", key_id,
-        "--passphrase", key_passphrase,
-        "-o", output_file,
-        input_file
-    ], stderr=subprocess.DEVNULL)
+    GpgSession().sign(key_id, key_passphrase, input_file, output_file, detached)
 
 
 def gpg_dearmor(key_content, output_filename=None, overwrite=True):
@@ -122,6 +153,146 @@ def gpg_dearmor(key_content, output_filename=None, overwrite=True):
         args.append("--yes")
     if output_filename is not None:
         args.extend(["-o", output_filename])
-    p = subprocess.run(args, input=key_content, capture_output=True)
+    p = run_subprocess(args, input=key_content, capture_output=True)
     if output_filename is None:
         return p.stdout
+
+
+def gpgv_verify(content, keyrings, signature_file=None):
+    """Verify content against the keys in keyrings, returning the signed data.
+
+    content is either clearsigned, or the data signed by the detached signature in signature_file.
+    """
+    args = ["gpgv", "--quiet"]
+    for keyring in keyrings:
+        args.extend(["--keyring", os.path.abspath(keyring)])
+    args.extend(["--output", "-"])
+    args.extend([signature_file, "-"] if signature_file is not None else ["-"])
+    p = run_subprocess(args, input=content, capture_output=True)
+    if p.returncode != 0:
+        raise Exception(f"Signature verification failed: {p.stderr.decode(errors='replace').strip()}")
+    return content if signature_file is not None else p.stdout
+
+
+# Hash algorithm ids from RFC 4880 9.4, as reported in SIG_CREATED status lines, mapped to clearsign Hash: names
+gpg_hash_algorithm_names = {
+    "1": "MD5", "2": "SHA1", "3": "RIPEMD160", "8": "SHA256", "9": "SHA384", "10": "SHA512", "11": "SHA224",
+}
+
+
+class GpgSession(object):
+    """A gpg keyring, optionally isolated in its own GNUPGHOME, with a warm agent and cached key listings."""
+
+    def __init__(self, homedir=None):
+        self.homedir = homedir
+        if homedir is not None:
+            os.makedirs(homedir, mode=0o700, exist_ok=True)
+        self._key_lists = {}
+        self._agent_started = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _args(self, *args):
+        return ["gpg", "--batch", "--no-tty", *(["--homedir", self.homedir] if self.homedir else []), *args]
+
+    def _gpgconf(self, *args):
+        return ["gpgconf", *(["--homedir", self.homedir] if self.homedir else []), *args]
+
+    def start_agent(self):
+        if not self._agent_started:
+            check_output(self._gpgconf("--launch", "gpg-agent"), stderr=subprocess.DEVNULL)
+            self._agent_started = True
+
+    def close(self):
+        if self._agent_started and self.homedir is not None:
+            run_subprocess(self._gpgconf("--kill", "gpg-agent"), capture_output=True)
+        self._agent_started = False
+
+    def list_keys(self, secret=False, key_id=None):
+        args = self._args("--list-secret-keys" if secret else "--list-keys", "--with-colons")
+        if key_id is not None:
+            return gpg_read_key_list(args + [key_id])
+        if secret not in self._key_lists:
+            self._key_lists[secret] = gpg_read_key_list(args)
+        return self._key_lists[secret]
+
+    def show_keys(self, filename=None, content=None):
+        assert not (filename is not None and content is not None)
+        return gpg_read_key_list(self._args("--show-keys", "--with-colons", *([filename] if filename else [])),
+                                 content)
+
+    def import_key(self, key_file):
+        self._key_lists.clear()
+        return check_output(self._args("--import", key_file), stderr=subprocess.DEVNULL)
+
+    def gen_key(self, **key_meta):
+        assert 'Passphrase' in key_meta
+        gpg_batch = "\n".join(f"{k}: {v}" for k, v in key_meta.items())
+        gpg_batch += "\n"
+        gpg_batch += "\n".join(["%no-ask-passphrase", "%no-protection", "%commit"])
+        gpg_batch += "\n"
+        self._key_lists.clear()
+        status = check_output(self._args("--status-fd", "1", "--gen-key"),
+                              input=gpg_batch.encode(), stderr=subprocess.DEVNULL).decode()
+        return re.search(r"^\[GNUPG:] KEY_CREATED [BPS] ([0-9A-F]+)", status, re.MULTILINE).group(1)[-16:]
+
+    def export_secret_key(self, key_id, output_file):
+        check_output(self._args("--export-secret-keys", "--armor", "--yes", "-o", output_file, key_id),
+                     stderr=subprocess.DEVNULL)
+
+    def export_key(self, key_id, output_file):
+        check_output(self._args("--export", "--armor", "--yes", "--output", output_file, key_id),
+                     stderr=subprocess.DEVNULL)
+
+    def sign(self, key_id, key_passphrase, input_file, output_file, detached=False):
+        self.start_agent()
+        check_output(self._args(
+            "--sign",
+            "--detach-sign" if detached else "--clearsign",
+            "--armor",
+            "--yes",
+            "--pinentry-mode", "loopback",
+            "--default-key", key_id,
+            "--passphrase", key_passphrase,
+            "-o", output_file,
+            input_file
+        ), stderr=subprocess.DEVNULL)
+
+    def sign_detached_and_clearsigned(self, key_id, key_passphrase, input_file, detached_file, clearsigned_file):
+        with open(input_file, "rb") as fp:
+            content = fp.read()
+        lines = content.decode().split("\n")
+        if not content.endswith(b"\n") or any(line != line.rstrip() for line in lines):
+            # Text mode signatures over trailing whitespace do not carry over to the cleartext framework
+            self.sign(key_id, key_passphrase, input_file, detached_file, detached=True)
+            self.sign(key_id, key_passphrase, input_file, clearsigned_file)
+            return
+        self.start_agent()
+        # A text mode detached signature over a file ending in a newline also verifies a cleartext message of the
+        # same lines followed by an empty one, so both files come from a single signing operation.
+        status = check_output(self._args(
+            "--status-fd", "1",
+            "--detach-sign",
+            "--textmode",
+            "--armor",
+            "--yes",
+            "--pinentry-mode", "loopback",
+            "--default-key", key_id,
+            "--passphrase", key_passphrase,
+            "-o", detached_file,
+            input_file
+        ), stderr=subprocess.DEVNULL).decode()
+        hash_algorithm = re.search(r"^\[GNUPG:] SIG_CREATED \S+ \S+ (\d+) ", status, re.MULTILINE).group(1)
+        with open(detached_file, "r") as fp:
+            signature = fp.read()
+        with open(f"{clearsigned_file}.tmp", "w") as fp:
+            fp.write("-----BEGIN PGP SIGNED MESSAGE-----\n")
+            fp.write(f"Hash: {gpg_hash_algorithm_names[hash_algorithm]}\n\n")
+            fp.write("".join(f"- {line}\n" if line.startswith("-") else f"{line}\n" for line in lines[:-1]))
+            fp.write("\n")
+            fp.write(signature)
+        os.replace(f"{clearsigned_file}.tmp", clearsigned_file)
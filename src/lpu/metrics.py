@@ -0,0 +1,137 @@
+import contextlib
+import functools
+import json
+import os
+import resource
+import subprocess
+import threading
+import time
+
+
+class Metrics(object):
+    """Process-wide timings and counters of a run, reported as JSON, text or a Prometheus textfile."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.stages = {}
+        self.counters = {}
+        self.subprocesses = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Time a stage of the run. CPU time covers all threads, and child processes separately."""
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        times = os.times()
+        try:
+            yield
+        finally:
+            children_times = os.times()
+            children_cpu = (children_times.children_user + children_times.children_system
+                            - times.children_user - times.children_system)
+            with self._lock:
+                stage = self.stages.setdefault(
+                    name, {"count": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0, "children_cpu_seconds": 0.0})
+                stage["count"] += 1
+                stage["wall_seconds"] += time.perf_counter() - wall
+                stage["cpu_seconds"] += time.process_time() - cpu
+                stage["children_cpu_seconds"] += children_cpu
+
+    def add(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record_subprocess(self, args, seconds):
+        command = os.path.basename(args[0] if isinstance(args, (list, tuple)) else str(args).split()[0])
+        with self._lock:
+            entry = self.subprocesses.setdefault(command, {"count": 0, "seconds": 0.0})
+            entry["count"] += 1
+            entry["seconds"] += seconds
+
+    def report(self):
+        # ru_maxrss is in KiB on Linux
+        with self._lock:
+            return {
+                "wall_seconds": time.time() - self.started,
+                "stages": {k: dict(v) for k, v in self.stages.items()},
+                "counters": dict(self.counters),
+                "subprocesses": {k: dict(v) for k, v in self.subprocesses.items()},
+                "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+                "children_peak_rss_bytes": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+            }
+
+    def format_text(self):
+        report = self.report()
+        lines = [f"Total: {report['wall_seconds']:.3f}s wall, peak RSS {report['peak_rss_bytes'] / 2 ** 20:.1f} MiB"]
+        for name, stage in report["stages"].items():
+            lines.append(f"  {name:<24} {stage['wall_seconds']:>9.3f}s wall {stage['cpu_seconds']:>9.3f}s cpu "
+                         f"{stage['children_cpu_seconds']:>9.3f}s children cpu")
+        for name, value in sorted(report["counters"].items()):
+            lines.append(f"  {name:<24} {value:>12}")
+        for command, entry in sorted(report["subprocesses"].items()):
+            lines.append(f"  {command:<24} {entry['count']:>5} spawned {entry['seconds']:>9.3f}s")
+        return "\n".join(lines) + "\n"
+
+    def format_json(self):
+        return json.dumps(self.report(), indent=2, sort_keys=True) + "\n"
+
+    def format_prometheus(self, prefix="lpu"):
+        report = self.report()
+        lines = []
+
+        def _metric(name, metric_type, help_text, samples):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} {metric_type}")
+            for labels, value in samples:
+                label_text = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f"{prefix}_{name}{{{label_text}}} {value}" if label_text else f"{prefix}_{name} {value}")
+
+        _metric("last_run_timestamp_seconds", "gauge", "When the last run started.", [({}, self.started)])
+        _metric("run_wall_seconds", "gauge", "Wall time of the last run.", [({}, report["wall_seconds"])])
+        for field in ["wall_seconds", "cpu_seconds", "children_cpu_seconds"]:
+            _metric(f"stage_{field}", "gauge", f"Stage {field.replace('_', ' ')} of the last run.",
+                    [({"stage": name}, stage[field]) for name, stage in report["stages"].items()])
+        for name, value in sorted(report["counters"].items()):
+            _metric(name, "gauge", f"{name.replace('_', ' ').capitalize()} in the last run.", [({}, value)])
+        _metric("subprocess_spawns", "gauge", "Subprocesses spawned in the last run.",
+                [({"command": command}, entry["count"]) for command, entry in sorted(report["subprocesses"].items())])
+        _metric("subprocess_seconds", "gauge", "Wall time spent in subprocesses in the last run.",
+                [({"command": command}, entry["seconds"]) for command, entry in sorted(report["subprocesses"].items())])
+        _metric("peak_rss_bytes", "gauge", "Peak resident set size of the last run.",
+                [({}, report["peak_rss_bytes"])])
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus_textfile(self, filename):
+        # The node exporter may read the file at any time, so it is replaced atomically
+        with open(f"{filename}.tmp", "w") as fp:
+            fp.write(self.format_prometheus())
+        os.replace(f"{filename}.tmp", filename)
+
+
+metrics = Metrics()
+
+timing_formats = ["text", "json"]
+
+
+def timed_subprocess(fn):
+    @functools.wraps(fn)
+    def wrapper(args, *a, **kw):
+        start = time.perf_counter()
+        try:
+            return fn(args, *a, **kw)
+        finally:
+            metrics.record_subprocess(args, time.perf_counter() - start)
+
+    return wrapper
+
+
+check_output = timed_subprocess(subprocess.check_output)
+run_subprocess = timed_subprocess(subprocess.run)
+
+
+def emit_report(config):
+    if config["timings"]:
+        print((metrics.format_json if config["timings"] == "json" else metrics.format_text)(), end="")
+    if config["prometheus_textfile"]:
+        metrics.write_prometheus_textfile(config["prometheus_textfile"])
@@ -0,0 +1,142 @@
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import stat
+
+from lpu.common import hash_file, hash_files, walk_files
+
+FICLONE = 0x40049409
+
+link_modes = ["hardlink", "reflink", "copy"]
+
+
+def reflink_file(src, dst):
+    with open(src, "rb") as src_fp, open(dst, "wb") as dst_fp:
+        try:
+            fcntl.ioctl(dst_fp.fileno(), FICLONE, src_fp.fileno())
+        except OSError:
+            dst_fp.close()
+            os.remove(dst)
+            raise
+
+
+def link_file(src, dst, mode="hardlink"):
+    tmp_dst = f"{dst}.tmp"
+    if os.path.lexists(tmp_dst):
+        os.remove(tmp_dst)
+    methods = {"hardlink": [os.link, shutil.copyfile], "reflink": [reflink_file, shutil.copyfile],
+               "copy": [shutil.copyfile]}[mode]
+    for method in methods:
+        try:
+            method(src, tmp_dst)
+            break
+        except OSError as e:
+            if method is methods[-1] or e.errno not in {errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.EINVAL,
+                                                        errno.EMLINK, errno.ENOTTY}:
+                raise
+            logging.debug(f"Could not {mode} {src} to {dst} ({e}), falling back to a copy")
+    os.replace(tmp_dst, dst)
+
+
+class PackageStore(object):
+    """Content-addressed store of package files, shared between repositories and linked into their pools."""
+
+    def __init__(self, store_dir, link_mode="hardlink"):
+        if link_mode not in link_modes:
+            raise Exception(f"Unknown link mode {link_mode}, expected one of {', '.join(link_modes)}")
+        self.store_dir = store_dir
+        self.link_mode = link_mode
+        self.blobs_dir = os.path.join(store_dir, "sha256")
+        self.roots_file = os.path.join(store_dir, "roots")
+        os.makedirs(self.blobs_dir, exist_ok=True)
+
+    def blob_path(self, sha256):
+        return os.path.join(self.blobs_dir, sha256[:2], sha256)
+
+    def has(self, sha256):
+        return os.path.isfile(self.blob_path(sha256))
+
+    def prepare(self, sha256):
+        os.makedirs(os.path.dirname(self.blob_path(sha256)), exist_ok=True)
+        return self.blob_path(sha256)
+
+    def add(self, filepath, sha256):
+        if not self.has(sha256):
+            link_file(filepath, self.prepare(sha256), self.link_mode)
+            os.chmod(self.blob_path(sha256), stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+
+    def link(self, sha256, filepath, hash_cache=None):
+        blob = self.blob_path(sha256)
+        if os.path.isfile(filepath):
+            if os.path.samefile(blob, filepath):
+                return
+            # Reflinks and copies are separate files, replacing them would only change their inode and mtime
+            if os.path.getsize(filepath) == os.path.getsize(blob):
+                hexdigests, _ = hash_file(filepath, {"sha256": hashlib.sha256}, hash_cache)
+                if hexdigests["sha256"] == sha256:
+                    return
+        os.chmod(blob, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        link_file(blob, filepath, self.link_mode)
+
+    def read_roots(self):
+        if not os.path.isfile(self.roots_file):
+            return []
+        with open(self.roots_file, "r") as fp:
+            return [line.rstrip("\n") for line in fp if line.strip()]
+
+    def write_roots(self, roots):
+        with open(f"{self.roots_file}.tmp", "w") as fp:
+            fp.write("".join(f"{root}\n" for root in sorted(set(roots))))
+        os.replace(f"{self.roots_file}.tmp", self.roots_file)
+
+    def register_root(self, directory):
+        directory = os.path.abspath(directory)
+        roots = self.read_roots()
+        if directory not in roots:
+            self.write_roots(roots + [directory])
+
+    def iter_blobs(self):
+        for f in walk_files(self.blobs_dir):
+            if not f.endswith((".tmp", ".partial")):
+                yield os.path.basename(f), f
+
+    def gc(self, hash_cache=None, dry_run=False, hash_engine=None):
+        roots = [root for root in self.read_roots() if os.path.isdir(root)]
+        root_files = {}
+        for f in (f for root in roots for f in walk_files(root) if f.endswith(".deb")):
+            st = os.stat(f)
+            root_files[f] = (st.st_dev, st.st_ino)
+        inodes = set(root_files.values())
+        blobs = []
+        for sha256, f in self.iter_blobs():
+            st = os.stat(f)
+            blobs.append((sha256, f, st.st_size, (st.st_dev, st.st_ino)))
+        unreferenced = [(sha256, f, size) for sha256, f, size, inode in blobs if inode not in inodes]
+        if unreferenced:
+            # Reflinked and copied files (including hardlinks that fell back to a copy) do not share inodes with
+            # their blobs, compare those by content instead.
+            blob_inodes = {inode for _, _, _, inode in blobs}
+            referenced = {
+                sha256
+                for sha256, _, _ in hash_files((f for f, inode in root_files.items() if inode not in blob_inodes),
+                                               hashlib.sha256, hash_cache, hash_engine)
+            }
+            unreferenced = [(sha256, f, size) for sha256, f, size in unreferenced if sha256 not in referenced]
+        reclaimed = 0
+        for sha256, f, size in unreferenced:
+            logging.info(f"{'Would remove' if dry_run else 'Removing'} unreferenced blob {sha256} ({size} bytes)")
+            if not dry_run:
+                os.remove(f)
+            reclaimed += size
+        if not dry_run:
+            self.write_roots(roots)
+        return len(unreferenced), reclaimed
+
+
+def get_package_store(config):
+    if not config["store_dir"]:
+        return None
+    return PackageStore(config["store_dir"], config["link_mode"])